@@ -0,0 +1,192 @@
+# asyncio counterpart of GPUConnection. Commands are written as soon as they're
+# asked for, and each reply is matched to the oldest command still waiting for
+# one, so many can be in flight at once and one event loop can drive several
+# boards. Display list commands are matched to commit acks the same way, the
+# device commits them in the order they were sent.
+import os
+import asyncio
+from collections import deque
+from struct import pack, unpack, calcsize
+from serial import Serial
+
+import uart
+import geometry
+from uart import Stats
+
+
+class AsyncGPUConnection():
+	coord_max = 0xff
+	index_max = 2**14
+	baud = 115200
+
+	rx_budget = uart.rx_depth  # see GPUConnection.rx_budget
+
+	def __init__(self, serial_device="/dev/ttyUSB1"):
+		# needs a running event loop, see open()
+		self.loop = asyncio.get_running_loop()
+		self.conn = Serial(serial_device, self.baud, timeout=0, write_timeout=0)
+		self.fd = self.conn.fileno()
+		# (future, reply length, bytes written up to the command) in the order sent
+		self.replies = deque()
+		self.commits = deque()  # (future, bytes written) of display list commands not committed yet
+		self.reply = bytearray()  # reply being received for replies[0]
+		self.tx = bytearray()  # not written yet, the serial port was full
+		# Commands are processed in order, so a reply means every byte up to its
+		# command has left the device's RX FIFO. Writing waits while more than
+		# rx_budget bytes could still be in there, e.g. behind a vsync.
+		self.written = 0
+		self.acked = 0
+		self.progress = asyncio.Event()  # set whenever acked moves
+		self.loop.add_reader(self.fd, self._receive)
+
+	@classmethod
+	async def open(cls, serial_device="/dev/ttyUSB1", **kwargs):
+		gpu = cls(serial_device, **kwargs)
+		if not await gpu.alive():
+			gpu.close()
+			raise ConnectionError("Could not establish serial connection")
+		return gpu
+
+	def close(self):
+		self.loop.remove_reader(self.fd)
+		self.loop.remove_writer(self.fd)
+		for future, *_ in [*self.replies, *self.commits]:
+			if not future.done():
+				future.set_exception(ConnectionError("Connection closed"))
+		self.replies.clear()
+		self.commits.clear()
+		self.conn.close()
+
+	def _receive(self):
+		try:
+			data = os.read(self.fd, 4096)
+		except BlockingIOError:
+			return
+		for byte in data:
+			# commit acks only come between replies, and are never a reply's first byte
+			if not self.reply and byte == uart.commit_ack:
+				if self.commits:
+					future, end = self.commits.popleft()
+					self._consumed(end)
+					if not future.done():
+						future.set_result(True)
+				continue
+			if not self.replies:
+				continue  # nothing asked for it, dropped
+
+			self.reply.append(byte)
+			future, length, end = self.replies[0]
+			# a reply that doesn't start with ack carries nothing more
+			if len(self.reply) == length or self.reply[0] != uart.ack:
+				self.replies.popleft()
+				self._consumed(end)
+				if not future.done():
+					future.set_result(bytes(self.reply))
+				self.reply.clear()
+
+	def _consumed(self, end):
+		self.acked = max(self.acked, end)
+		self.progress.set()
+
+	async def _room(self, size):
+		# a message bigger than the whole budget still goes out once nothing is in flight
+		while self.written - self.acked + size > self.rx_budget and self.written != self.acked:
+			self.progress.clear()
+			await self.progress.wait()
+
+	def _write(self, data):
+		self.written += len(data)
+		self.tx += data
+		self._flush()
+
+	def _flush(self):
+		try:
+			written = os.write(self.fd, self.tx)
+		except BlockingIOError:
+			written = 0
+		del self.tx[:written]
+		if self.tx:
+			self.loop.add_writer(self.fd, self._flush)
+		else:
+			self.loop.remove_writer(self.fd)
+
+	async def _command(self, msg, length=1):
+		# Returns the reply to msg. Queuing it and writing it happen together, so
+		# replies come back in the same order as the queue.
+		await self._room(len(msg))
+		future = self.loop.create_future()
+		self.replies.append((future, length, self.written + len(msg)))
+		self._write(msg)
+		return await future
+
+	async def _ack(self, msg):
+		return await self._command(msg) == pack('B', uart.ack)
+
+	async def alive(self):
+		return await self._command(pack('B', uart.commands["ping"])) == pack('B', uart.ping_res)
+
+	def _check_segments(self, segments):
+		return geometry.check_segments(segments, self.coord_max)
+
+	async def send_segment(self, index, coords):  # x y x y
+		coords = self._check_segments(coords)[0]
+		return await self._ack(pack('<BH4B', uart.commands["write"], index % self.index_max, *coords))
+
+	async def send_segments(self, start_index, segments, batch=None):
+		# Batches are written as soon as rx_budget allows, their acks are awaited
+		# together. By default a batch is small enough for two to be in flight.
+		segments = self._check_segments(segments)
+		largest = (self.rx_budget - 5) // 4
+		batch = min(batch or (self.rx_budget // 2 - 5) // 4, largest)
+		acks = []
+		for offset in range(0, len(segments), batch):
+			chunk = segments[offset:offset+batch]
+			index = (start_index + offset) % self.index_max
+			msg = pack('<B2H', uart.commands["write_bulk"], index, len(chunk)) + chunk.tobytes()
+			acks.append(self._ack(msg))
+		return all(await asyncio.gather(*acks))
+
+	async def set_bounds(self, start_index, end_index, wait=True):
+		# Like GPUConnection.set_bounds: returns once the device commits it at
+		# a vsync, or right away without wait, to be confirmed by wait_commit().
+		msg = pack('<B2H', uart.commands["set_bounds"], start_index % self.index_max,
+			end_index % self.index_max)
+		return await self._send_list(msg, wait)
+
+	async def set_ranges(self, ranges, wait=True):
+		# (start, end) or (start, end, indexed) ranges, see GPUConnection.set_ranges
+		ranges = list(ranges)
+		if len(ranges) > uart.max_ranges:
+			raise ValueError(f"At most {uart.max_ranges} ranges fit in the display list")
+
+		msg = pack('<BB', uart.commands["set_ranges"], len(ranges))
+		for start, end, *indexed in ranges:
+			start %= self.index_max
+			if indexed and indexed[0]:
+				start |= uart.indexed_range
+			msg += pack('<2H', start, end % self.index_max)
+		return await self._send_list(msg, wait)
+
+	async def _send_list(self, msg, wait):
+		await self._room(len(msg))
+		future = self.loop.create_future()
+		self.commits.append((future, self.written + len(msg)))
+		self._write(msg)
+		if wait:
+			return await future
+		return True
+
+	async def wait_commit(self):
+		return all(await asyncio.gather(*(future for future, _ in self.commits)))
+
+	async def vsync(self):
+		return await self._ack(pack('B', uart.commands["vsync"]))
+
+	async def stats(self):
+		reply = await self._command(pack('B', uart.commands["stats"]), 1 + calcsize(uart.stats_format))
+		if reply[:1] != pack('B', uart.ack):
+			raise ConnectionError("Stats request was not acknowledged")
+		return Stats(*unpack(uart.stats_format, reply[1:]))
+
+	async def blank(self):
+		return await self.set_bounds(0, 0)
@@ -0,0 +1,96 @@
+from bisect import insort
+import numpy as np
+
+
+class SegmentAllocator():
+	# Hands out contiguous ranges of the device's segment memory, one per handle.
+	# Index 0 is reserved since LineSet never draws it.
+	def __init__(self, size=2**14, reserved=1):
+		self.size = size
+		self.ranges = {}  # handle -> (start, length)
+		self.free = [(reserved, size - reserved)]  # sorted (start, length)
+
+	def alloc(self, handle, length):
+		if handle in self.ranges:
+			raise KeyError(f"{handle!r} is already allocated")
+		if length <= 0:
+			raise ValueError("Allocations must hold at least one segment")
+
+		for i, (start, free_length) in enumerate(self.free):  # first fit
+			if free_length >= length:
+				if free_length == length:
+					del self.free[i]
+				else:
+					self.free[i] = (start + length, free_length - length)
+				self.ranges[handle] = (start, length)
+				return start
+		raise MemoryError(f"No free range of {length} segments")
+
+	def release(self, handle):
+		start, length = self.ranges.pop(handle)
+		self._add_free(start, length)
+
+	def _add_free(self, start, length):
+		insort(self.free, (start, length))
+		merged = []
+		for s, l in self.free:
+			if merged and merged[-1][0] + merged[-1][1] == s:
+				merged[-1] = (merged[-1][0], merged[-1][1] + l)
+			else:
+				merged.append((s, l))
+		self.free = merged
+
+	def largest_free(self):
+		# the longest allocation that would fit right now
+		return max((length for _, length in self.free), default=0)
+
+	def spans(self, *handles):
+		# (first, last) index ranges of the handles, ready for set_ranges, with
+		# allocations that are next to each other merged into one range
+		if not handles:
+			handles = self.ranges.keys()
+		spans = []
+		for start, length in sorted(self.ranges[h] for h in handles):
+			if spans and spans[-1][1] + 1 == start:
+				spans[-1] = (spans[-1][0], start + length - 1)
+			else:
+				spans.append((start, start + length - 1))
+		return spans
+
+	def bounds(self, *handles):
+		# first and last index of the handles, ready for set_bounds. Anything
+		# between them would be drawn too, so they have to be contiguous.
+		spans = self.spans(*handles)
+		if len(spans) != 1:
+			raise ValueError("Allocations are not contiguous, use spans() with set_ranges")
+		return spans[0]
+
+	def compact(self, gpu, max_moves=1):
+		# Slide the allocation just above the lowest hole it fits in down into it,
+		# at most `max_moves` times per call so it can run between frames. Only the
+		# moved segments are sent, copied from the connection's shadow of segment
+		# memory. An allocation is only moved into a hole at least as long as it,
+		# so the old copy the display list still draws is never overwritten.
+		# Returns the moved handles, whose bounds need to be set again.
+		moved = []
+		for _ in range(max_moves):
+			starts = {s: (h, l) for h, (s, l) in self.ranges.items()}
+			for i, (hole_start, hole_length) in enumerate(self.free):
+				handle, length = starts.get(hole_start + hole_length, (None, 0))
+				if handle is not None and length <= hole_length:
+					break
+			else:
+				break  # nothing fits below where it is
+
+			start = hole_start + hole_length
+			old = start + np.arange(length)
+			if not gpu.shadow_valid[old].all():
+				raise RuntimeError(f"Segments of {handle!r} were not uploaded through this connection")
+			if not gpu.send_segments(hole_start, gpu.shadow[old].copy()):
+				raise ConnectionError(f"Moving {handle!r} was not acknowledged")
+
+			self.ranges[handle] = (hole_start, length)
+			del self.free[i]
+			self._add_free(hole_start + length, hole_length)
+			moved.append(handle)
+		return moved
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# Cycle counts for LineSet drawing synthetic scenes, from the Amaranth simulator.
+# Results go to a JSON file so they can be compared between commits.
+import json
+import random
+import argparse
+import subprocess
+from amaranth.sim import Simulator, Settle
+
+from lines import LineSet
+from vga import VGA
+
+px_freq = 25.125e6
+width = 160
+height = 120
+index_max = 2**14
+
+
+def workloads(count):
+	rng = random.Random(0)
+
+	short = []
+	for _ in range(count):
+		x, y = rng.randrange(4, width-4), rng.randrange(4, height-4)
+		short.append((x, y, x + rng.randint(-3, 3), y + rng.randint(-3, 3)))
+
+	diagonal = []
+	for i in range(count):
+		if i % 2:
+			diagonal.append((0, height-1, height-1, 0))
+		else:
+			diagonal.append((0, 0, height-1, height-1))
+
+	horizontal = [(0, i % height, width-1, i % height) for i in range(count)]
+	vertical = [(i % width, 0, i % width, height-1) for i in range(count)]
+
+	return {
+		"short": short,
+		"long_diagonal": diagonal,
+		"horizontal": horizontal,
+		"vertical": vertical,
+	}
+
+
+def run(segments, drawers=1):
+	dut = LineSet(width, height, drawers=drawers)
+	sim = Simulator(dut)
+	sim.add_clock(1 / px_freq, domain="px")
+	result = {}
+
+	def process():
+		# load through the same write port the UART uses, one write per 2 cycles
+		for i, (x0, y0, x1, y1) in enumerate(segments, start=1):
+			yield dut.index_write.eq(i)
+			yield dut.endpoints_in[0].x.eq(x0)
+			yield dut.endpoints_in[0].y.eq(y0)
+			yield dut.endpoints_in[1].x.eq(x1)
+			yield dut.endpoints_in[1].y.eq(y1)
+			yield dut.request_write.eq(1)
+			yield
+			yield dut.request_write.eq(0)
+			yield
+		yield
+		yield
+
+		yield dut.range_starts[0].eq(1)
+		yield dut.range_ends[0].eq(len(segments))
+		yield dut.start.eq(1)
+		yield
+		yield dut.start.eq(0)
+
+		cycles = 0
+		pixels = 0
+		while True:
+			yield Settle()
+			if not (yield dut.busy):
+				break
+			if (yield dut.write):
+				pixels += bin((yield dut.mask)).count("1")
+			cycles += 1
+			yield
+		result["cycles"] = cycles
+		result["pixels"] = pixels
+
+	sim.add_sync_process(process, domain="px")
+	sim.run()
+	return result
+
+
+def main():
+	parser = argparse.ArgumentParser(description="LineSet rendering benchmark")
+	parser.add_argument("--segments", type=int, default=64, help="segments per scene")
+	parser.add_argument("--drawers", type=int, default=1, help="LineSet drawer count")
+	parser.add_argument("--fast-render", action="store_true",
+		help="LineSet in the render domain, at twice the px clock")
+	parser.add_argument("--output", default="bench.json")
+	args = parser.parse_args()
+
+	frame_cycles = VGA.frame_cycles
+	if args.fast_render:
+		frame_cycles *= 2  # LineSet cycles per frame, see VGA_PLL
+
+	try:
+		commit = subprocess.run(["git", "rev-parse", "HEAD"],
+			capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		commit = None
+
+	report = {
+		"commit": commit,
+		"drawers": args.drawers,
+		"fast_render": args.fast_render,
+		"px_freq": px_freq,
+		"frame_cycles": frame_cycles,
+		"workloads": {},
+	}
+	for name, segments in workloads(args.segments).items():
+		result = run(segments, args.drawers)
+		cycles_per_segment = result["cycles"] / len(segments)
+		result.update({
+			"segments": len(segments),
+			"cycles_per_segment": cycles_per_segment,
+			"pixels_per_cycle": result["pixels"] / result["cycles"],
+			# extrapolated, the scene repeats its mix of lines
+			"max_segments_per_frame": min(int(frame_cycles // cycles_per_segment), index_max - 1),
+		})
+		report["workloads"][name] = result
+		print(f"{name:>14}: {cycles_per_segment:7.2f} cycles/segment, "
+			f"{result['pixels_per_cycle']:.3f} pixels/cycle, "
+			f"{result['max_segments_per_frame']} segments/frame")
+
+	with open(args.output, "w") as f:
+		json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+	main()
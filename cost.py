@@ -0,0 +1,62 @@
+import numpy as np
+
+import uart
+from vga import VGA
+
+# LineSet timing, in cycles of the domain it runs in
+px_freq = uart.clk_freq
+frame_cycles = VGA.frame_cycles
+pipeline_cycles = 9  # first segment through both memories and the transform
+span = 4  # pixels a drawer writes at once along a row, FrameBuffer.pixels_per_word
+
+
+def segment_cycles(segments, span=span):
+	# Cycles a drawer spends on each of an (N,4) array of x y x y. A drawer
+	# takes a cycle to pick a segment up, then steep lines go out a pixel per
+	# cycle, max(|dx|,|dy|)+1 of them. Shallow lines go out up to `span` pixels
+	# of a row at a time, so about one cycle per row and per word crossed.
+	seg = np.asarray(segments, dtype=np.int32).reshape(-1, 4)
+	dx = np.abs(seg[:, 2] - seg[:, 0])
+	dy = np.abs(seg[:, 3] - seg[:, 1])
+	return np.where(dx >= dy, dx // span + dy + 1, dy + 1) + 1
+
+
+def _busy(cycles, drawers):
+	# Every drawing cycle is a framebuffer write, and LineSet only takes one per
+	# cycle, so more drawers only hide the pickup cycles. The fetch pipeline
+	# hands out at most one segment per cycle.
+	writes = cycles - 1
+	count = np.arange(1, len(cycles) + 1)
+	return np.maximum(np.maximum(np.cumsum(writes), np.cumsum(cycles) / drawers), count)
+
+
+def frame_cost(segments, drawers=1, span=span):
+	# estimated LineSet busy cycles for drawing all of them
+	cycles = segment_cycles(segments, span)
+	if len(cycles) == 0:
+		return 0
+	return int(_busy(cycles, drawers)[-1]) + pipeline_cycles
+
+
+def frame_budget(fast_render=False, margin=0.95):
+	# LineSet cycles in one refresh, less a margin for the estimate being off.
+	# The render domain runs at twice the px clock.
+	return int(frame_cycles * (2 if fast_render else 1) * margin)
+
+
+def cull(segments, priority=None, budget=None, drawers=1, span=span):
+	# Which segments to keep so the frame fits in `budget` cycles: the highest
+	# priority ones first, then in order. Returns a boolean mask, so the kept
+	# segments stay in their original order.
+	cycles = segment_cycles(segments, span)
+	if budget is None:
+		budget = frame_budget()
+	if priority is None:
+		order = np.arange(len(cycles))
+	else:
+		order = np.argsort(-np.asarray(priority, dtype=float), kind="stable")
+	fits = _busy(cycles[order], drawers) + pipeline_cycles <= budget
+
+	keep = np.zeros(len(cycles), dtype=bool)
+	keep[order[fits]] = True
+	return keep
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# Software stand-in for the board: speaks the Top UART protocol over a pty so
+# GPUConnection can be pointed at it without an iCEBreaker attached.
+import os
+import tty
+import threading
+import numpy as np
+from struct import pack, unpack
+from time import monotonic, sleep
+
+import uart
+from uart import commands
+from cost import frame_cost, frame_cycles
+
+width = 160
+height = 120
+identity = (256, 0, 0, 256, 0, 0)  # reset value of LineSet's range transforms
+line_color = 1  # same as fb.w_data in Top
+fill_color = 4  # same as fb.fill_data in Top
+
+
+def unpack_edges(data, count):
+	# the 28 bit entries of a write_edges stream as (count,2) index pairs
+	raw = np.frombuffer(data + bytes(-len(data) % 7), dtype=np.uint8).reshape(-1, 7)
+	both = np.hstack([raw, np.zeros((len(raw), 1), dtype=np.uint8)]).view('<u8')[:, 0]
+	words = np.stack([both & 0xfffffff, both >> 28], axis=1).reshape(-1)[:count]
+	return np.stack([words & 0x3fff, words >> 14], axis=1).astype(np.uint16)
+
+
+def bresenham(segments):
+	# Rasterize all segments at once, stepping exactly like _LineDrawer.
+	# Returns the x and y coordinates of every pixel written, in draw order.
+	seg = np.asarray(segments, dtype=np.int32).reshape(-1, 4)
+	x = seg[:, 0].copy()
+	y = seg[:, 1].copy()
+	x_end = seg[:, 2]
+	y_end = seg[:, 3]
+
+	dx = np.abs(x_end - x)
+	dy = -np.abs(y_end - y)
+	sx = np.where(x > x_end, -1, 1)
+	sy = np.where(y > y_end, -1, 1)
+	error = dx + dy
+
+	active = np.ones(len(seg), dtype=bool)
+	xs, ys = [], []
+	for _ in range(1024):  # the drawer's x and y registers would have wrapped by now
+		if not active.any():
+			break
+		xs.append(x[active])
+		ys.append(y[active])
+
+		step_x = (error << 1) >= dy
+		step_y = (error << 1) <= dx
+		done = (x == x_end) & (y == y_end)
+		done |= step_x & ~step_y & (x == x_end)
+		done |= step_y & ~step_x & (y == y_end)
+
+		error = error + np.where(step_x, dy, 0) + np.where(step_y, dx, 0)
+		x = x + np.where(step_x, sx, 0)
+		y = y + np.where(step_y, sy, 0)
+		active &= ~done
+
+	if not xs:
+		return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+	return np.concatenate(xs), np.concatenate(ys)
+
+
+def transform(segments, matrix, offsets=((0, 0),), fraction_bits=8):
+	# Fixed point affine transform of (N,4) segments like _AffineTransform, with
+	# matrix as the (a, b, c, d, tx, ty) integers set_transform sends, repeated
+	# for each instance offset. Returns the clamped segments, instance by
+	# instance, and which of them aren't entirely off screen.
+	seg = np.asarray(segments, dtype=np.int64).reshape(-1, 4)
+	offsets = np.asarray(offsets, dtype=np.int64).reshape(-1, 2)
+	a, b, c, d, tx, ty = matrix
+	x = seg[:, 0::2]
+	y = seg[:, 1::2]
+	xt = (((a*x + b*y) >> fraction_bits) + tx + offsets[:, 0, None, None]).reshape(-1, 2)
+	yt = (((c*x + d*y) >> fraction_bits) + ty + offsets[:, 1, None, None]).reshape(-1, 2)
+
+	outside = (xt < 0).all(axis=1) | (xt >= width).all(axis=1)
+	outside |= (yt < 0).all(axis=1) | (yt >= height).all(axis=1)
+	out = np.empty((len(xt), 4), dtype=np.int64)
+	out[:, 0::2] = np.clip(xt, 0, width-1)
+	out[:, 1::2] = np.clip(yt, 0, height-1)
+	return out, ~outside
+
+
+class GPUEmulator():
+	index_max = 2**14
+
+	def __init__(self, frame_rate=60):
+		self.segments = np.zeros((self.index_max, 4), dtype=np.uint8)
+		self.edges = np.zeros((self.index_max, 2), dtype=np.uint16)  # vertex index pairs
+		self.buffers = np.full((2, height, width), fill_color, dtype=np.uint8)
+		self.front = 0  # buffer being displayed, the other one is drawn into
+		self.ranges = [(0, 10, False)]  # reset value of LineSet's display list
+		self.pending_ranges = None  # committed at the next frame
+		self.transforms = [identity] * uart.max_ranges
+		self.instances = [(0, 0)] * uart.max_ranges  # offset base and count per range
+		self.pending_transforms = {}
+		self.pending_instances = {}
+		self.commits_due = 0  # commands waiting for the next frame, one commit_ack each
+		self.hold_mode = False  # set by set_swap_mode, taken at the next swap
+		self.holding = False
+		self.drawing = 0  # estimated cycles LineSet still needs for the back buffer
+		self.frame_count = 0
+		self.frame_period = 1 / frame_rate
+		self.stats = dict.fromkeys(uart.stats_fields, 0)
+
+		self.lock = threading.Condition()
+		self.tx_lock = threading.Lock()
+		self.running = False
+		self.threads = []
+
+		self.master, self.slave = os.openpty()
+		tty.setraw(self.slave)
+		self.port = os.ttyname(self.slave)
+
+	def start(self):
+		self.running = True
+		self.threads = [
+			threading.Thread(target=self._vsync_loop, daemon=True),
+			threading.Thread(target=self._command_loop, daemon=True),
+		]
+		for thread in self.threads:
+			thread.start()
+
+	def stop(self):
+		with self.lock:
+			self.running = False
+			self.lock.notify_all()
+		os.close(self.slave)
+		os.close(self.master)
+
+	@property
+	def displayed(self):
+		with self.lock:
+			return self.buffers[self.front].copy()
+
+	def render(self, buffer):
+		drawn = [np.zeros((0, 4), dtype=np.int64)]
+		for (start, end, indexed), matrix, (base, count) in zip(self.ranges, self.transforms, self.instances):
+			if end >= start:
+				indices = np.arange(start, end+1)
+			else:  # LineSet's counter wraps around the end of segment memory
+				indices = np.r_[np.arange(start, self.index_max), np.arange(0, end+1)]
+			indices = indices[indices != 0]  # index 0 is never drawn
+			if indexed:
+				# vertices are stored in both halves, see _EdgeMemory
+				edges = self.edges[indices].astype(np.intp)
+				segments = np.hstack([self.segments[edges[:, 0], :2], self.segments[edges[:, 1], 2:]])
+			else:
+				segments = self.segments[indices]
+			if count:
+				# offsets are 14 bit two's complement pairs in edge memory
+				offsets = self.edges[(base + np.arange(count)) % self.index_max].astype(np.int64)
+				offsets = np.where(offsets & 0x2000, offsets - 0x4000, offsets)
+				segments, visible = transform(segments, matrix, offsets)
+			else:
+				segments, visible = transform(segments, matrix)
+			drawn.append(segments[visible])
+		drawn = np.concatenate(drawn)
+
+		x, y = bresenham(drawn)
+		buffer[y, x] = line_color
+
+		self.stats["segments"] = len(drawn)
+		self.stats["pixels"] = len(x)
+		self.stats["busy_cycles"] = frame_cost(drawn)
+
+	def _frame(self):
+		self.frame_count += 1
+		if self.drawing > frame_cycles:
+			self.drawing -= frame_cycles
+			self.stats["overruns"] = (self.stats["overruns"] + 1) % 2**16
+			if self.holding:
+				# the displayed frame is shown again, display list changes wait too
+				self.stats["held_frames"] = (self.stats["held_frames"] + 1) % 2**16
+				return
+
+		if self.pending_ranges is not None:
+			self.ranges = self.pending_ranges
+			self.pending_ranges = None
+		for range_index, matrix in self.pending_transforms.items():
+			self.transforms[range_index] = matrix
+		for range_index, instances in self.pending_instances.items():
+			self.instances[range_index] = instances
+		self.pending_transforms = {}
+		self.pending_instances = {}
+		if self.commits_due:
+			self._send(bytes([uart.commit_ack] * self.commits_due))
+			self.commits_due = 0
+
+		# the buffer that was just displayed got cleared by fill-on-read, or
+		# explicitly in hold mode
+		self.front ^= 1
+		self.holding = self.hold_mode
+		back = self.buffers[self.front ^ 1]
+		back[:] = fill_color
+		self.render(back)
+		self.drawing = self.stats["busy_cycles"]
+
+	def _wait_frame(self):
+		with self.lock:
+			frame = self.frame_count
+			while self.running and self.frame_count == frame:
+				self.lock.wait()
+
+	def _vsync_loop(self):
+		deadline = monotonic()
+		while self.running:
+			deadline += self.frame_period
+			sleep(max(0, deadline - monotonic()))
+			with self.lock:
+				self._frame()
+				self.lock.notify_all()
+
+	def _read(self, n):
+		data = b''
+		while len(data) < n:
+			chunk = os.read(self.master, n - len(data))
+			if not chunk:
+				raise EOFError
+			data += chunk
+		return data
+
+	def _send(self, data):
+		with self.tx_lock:
+			os.write(self.master, data)
+
+	def _reply(self, byte):
+		self._send(bytes([byte]))
+
+	def _store(self, index, coords):
+		coords = np.asarray(coords, dtype=np.uint8).reshape(-1, 4).copy()
+		coords[:, 1::2] &= 0x7f  # Coords.y is only 7 bits wide
+		indices = (index + np.arange(len(coords))) % self.index_max
+		with self.lock:
+			self.segments[indices] = coords
+
+	def _store_edges(self, index, data, count):
+		edges = unpack_edges(data, count) % self.index_max
+		indices = (index + np.arange(len(edges))) % self.index_max
+		with self.lock:
+			self.edges[indices] = edges
+
+	def _set_ranges(self, count):
+		# like Top, a new list replaces one still pending, both are acked at the commit
+		ranges = [unpack('<2H', self._read(4)) for _ in range(count)]
+		ranges = [(s % self.index_max, e % self.index_max, bool(s & uart.indexed_range))
+			for s, e in ranges]
+		with self.lock:
+			self.pending_ranges = ranges[:uart.max_ranges]
+			self.commits_due += 1
+
+	def _set_transform(self):
+		range_index, *matrix = unpack('<B6h', self._read(13))
+		with self.lock:
+			if range_index < uart.max_ranges:  # unknown ranges are dropped
+				self.pending_transforms[range_index] = tuple(matrix)
+			self.commits_due += 1
+
+	def _set_instances(self):
+		range_index, base, count = unpack('<B2H', self._read(5))
+		with self.lock:
+			if range_index < uart.max_ranges:
+				self.pending_instances[range_index] = (base % self.index_max, count % self.index_max)
+			self.commits_due += 1
+
+	def _command_loop(self):
+		try:
+			while self.running:
+				cmd = self._read(1)[0]
+				if cmd == commands["ping"]:
+					self._reply(uart.ping_res)
+				elif cmd == commands["write"]:
+					index, *coords = unpack('<H4B', self._read(6))
+					self._store(index, coords)
+					self._reply(uart.ack)
+				elif cmd == commands["write_bulk"]:
+					index, count = unpack('<2H', self._read(4))
+					self._store(index, np.frombuffer(self._read(4*count), dtype=np.uint8))
+					self._reply(uart.ack)
+				elif cmd == commands["write_vertices"]:
+					index, count = unpack('<2H', self._read(4))
+					points = np.frombuffer(self._read(2*count), dtype=np.uint8).reshape(-1, 2)
+					self._store(index, np.hstack([points, points]))
+					self._reply(uart.ack)
+				elif cmd in (commands["write_edges"], commands["write_offsets"]):
+					index, count = unpack('<2H', self._read(4))
+					self._store_edges(index, self._read((7*count + 1) // 2), count)
+					self._reply(uart.ack)
+				elif cmd == commands["set_bounds"]:
+					self._set_ranges(1)
+				elif cmd == commands["set_ranges"]:
+					self._set_ranges(self._read(1)[0])
+				elif cmd == commands["set_transform"]:
+					self._set_transform()
+				elif cmd == commands["set_instances"]:
+					self._set_instances()
+				elif cmd == commands["stats"]:
+					with self.lock:
+						reply = pack(uart.stats_format, *[self.stats[f] for f in uart.stats_fields])
+					self._send(bytes([uart.ack]) + reply)
+				elif cmd == commands["set_baud"]:
+					self._read(2)  # a pty carries any rate, so just confirm the next ping
+					self._reply(uart.ack)
+				elif cmd == commands["set_swap_mode"]:
+					mode = self._read(1)[0]
+					with self.lock:
+						self.hold_mode = mode == uart.swap_modes["hold"]
+					self._reply(uart.ack)
+				elif cmd == commands["vsync"]:
+					self._wait_frame()
+					self._reply(uart.ack)
+				# unknown bytes are dropped, like the CMD state does
+		except (EOFError, OSError):
+			pass
+
+
+if __name__ == "__main__":
+	gpu = GPUEmulator()
+	gpu.start()
+	print(f"Emulated GPU listening on {gpu.port}")
+	try:
+		while True:
+			sleep(1)
+	except KeyboardInterrupt:
+		gpu.stop()
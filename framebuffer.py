@@ -1,12 +1,13 @@
 from amaranth import *
+from amaranth.lib.cdc import FFSynchronizer, PulseSynchronizer
 from structures import Coords, Color
 
 
 class FrameBufferRAM(Elaboratable):
-	def __init__(self, width, height, init):
-		self.mem = Memory(width=3, depth=width*height, init=init)
+	def __init__(self, width, height, init, write_domain="px", pixels_per_word=1):
+		self.mem = Memory(width=3*pixels_per_word, depth=width*height, init=init)
 		self.rp = self.mem.read_port(transparent=False, domain="px")
-		self.wp = self.mem.write_port(domain="px")
+		self.wp = self.mem.write_port(domain=write_domain, granularity=3)
 
 	def elaborate(self, _platform):
 		m = Module()
@@ -15,29 +16,42 @@ class FrameBufferRAM(Elaboratable):
 		return m
 
 
-def pixels_to_fb(pix):
+def pixels_to_fb(pix, pixels_per_word=1):
 	init = []
-	for x in range(160):
+	for x in range(0, 160, pixels_per_word):
 		for y in range(120):
-			init += [pix[y][x]]
+			init += [sum(pix[y][x+i] << 3*i for i in range(pixels_per_word))]
 		init += [0]*8  # pad to width of 128
 	return init
 
 
 class FrameBuffer(Elaboratable):
-	def __init__(self):
+	# Reading, and everything driving coords_r, swap and read_fill, is in the px
+	# domain. Drawing through coords_w, w_data and write can be in a faster
+	# write_domain, the BRAMs have a separate clock per port.
+	# Each word holds pixels_per_word pixels of a row, so a span of them can be
+	# drawn at once, with w_mask selecting which.
+	pixels_per_word = 4
+
+	def __init__(self, write_domain="px"):
+		self.write_domain = write_domain
 		self.width = 160
 		self.height = 120
 		self.fb_width  = 128
-		self.fb_height = 160
+		self.fb_height = 160 // self.pixels_per_word
 
 		self.coords_r = Coords(self.width, self.height)
 		self.coords_w = Coords(self.width, self.height)
 		self.w_data = Signal(3)
+		self.w_mask = Signal(self.pixels_per_word)  # pixels of the word at coords_w
 		self.write = Signal()
 		self.swap = Signal()
-		self.read_fill = Signal()
+		self.read_fill = Signal()  # last read of the word at coords_r this frame
 		self.fill_data = Signal(3)
+		# Fills the whole buffer being drawn, for when it wasn't filled on read.
+		# In the write domain, drawing waits until clearing is low again.
+		self.clear = Signal()
+		self.clearing = Signal()
 		self.palette = Array(Signal(12) for _ in range(16))
 		self.color = Color(12)
 
@@ -50,48 +64,121 @@ class FrameBuffer(Elaboratable):
 			for x in range(i*10,i*10+20):
 				for y in range(i*10+20,i*10+40):
 					pix[y-3][x+40] = i+1
-		init0 = pixels_to_fb(pix)
+		init0 = pixels_to_fb(pix, self.pixels_per_word)
 
 		pix = [[0]*160 for _ in range(120)]
 		for i in range(7):
 			for x in range(i*10,i*10+20):
 				for y in range(i*10+20,i*10+40):
 					pix[y-3][x+40] = 7-i
-		init1 = pixels_to_fb(pix)
+		init1 = pixels_to_fb(pix, self.pixels_per_word)
 
-		m.submodules.fb0 = fb0 = FrameBufferRAM(self.fb_width, self.fb_height, init0)
-		m.submodules.fb1 = fb1 = FrameBufferRAM(self.fb_width, self.fb_height, init1)
+		wd = self.write_domain
+		ppw = self.pixels_per_word
+		word_bits = (ppw - 1).bit_length()
+		m.submodules.fb0 = fb0 = FrameBufferRAM(self.fb_width, self.fb_height, init0, wd, ppw)
+		m.submodules.fb1 = fb1 = FrameBufferRAM(self.fb_width, self.fb_height, init1, wd, ppw)
 
-		selected = Signal()  # selected fb is the one we write to
-		with m.If(self.swap):
-			m.d.px += selected.eq(~selected)
+		def address(coords):
+			return Cat(coords.y, coords.x[word_bits:])
+
+		# which pixel of the word is read, for when the data comes out
+		read_select = Signal(word_bits)
+		m.d.px += read_select.eq(self.coords_r.x[:word_bits])
+
+		selected = Signal()  # selected fb is the one we write to, in the write domain
+		selected_r = Signal()  # the same for the read side
+		swap = Signal()
+		fill = Signal()  # fill-on-read write, in the write domain
+		fill_coords = Coords(self.width, self.height)
+
+		if wd == "px":
+			m.d.comb += [
+				selected_r.eq(selected),
+				swap.eq(self.swap),
+				fill.eq(self.read_fill),
+				fill_coords.xy.eq(self.coords_r.xy),
+			]
+		else:
+			m.submodules.swap_sync = swap_sync = PulseSynchronizer("px", wd)
+			m.submodules.selected_sync = FFSynchronizer(selected, selected_r, o_domain="px")
+			m.d.comb += [swap_sync.i.eq(self.swap), swap.eq(swap_sync.o)]
+
+			# Fills are at least 16 px cycles apart, longer than a toggle takes to
+			# get across, so the held address is stable by the time it's written.
+			fill_toggle = Signal()
+			fill_toggle_w = Signal()
+			fill_toggle_last = Signal()
+			with m.If(self.read_fill):
+				m.d.px += fill_toggle.eq(~fill_toggle)
+				m.d.px += fill_coords.xy.eq(self.coords_r.xy)
+			m.submodules.fill_sync = FFSynchronizer(fill_toggle, fill_toggle_w, o_domain=wd)
+			m.d[wd] += fill_toggle_last.eq(fill_toggle_w)
+			m.d.comb += fill.eq(fill_toggle_w ^ fill_toggle_last)
+
+		with m.If(swap):
+			m.d[wd] += selected.eq(~selected)
+
+		depth = self.fb_width * self.fb_height
+		clear_addr = Signal(range(depth))
+		with m.If(self.clear):
+			m.d[wd] += [self.clearing.eq(1), clear_addr.eq(0)]
+		with m.Elif(self.clearing):
+			m.d[wd] += clear_addr.eq(clear_addr + 1)
+			with m.If(clear_addr == depth - 1):
+				m.d[wd] += self.clearing.eq(0)
+
+		draw_addr = Signal.like(fb0.wp.addr)
+		draw_data = Signal.like(fb0.wp.data)
+		draw_en = Signal.like(fb0.wp.en)
+		with m.If(self.clearing):
+			m.d.comb += [
+				draw_addr.eq(clear_addr),
+				draw_data.eq(Repl(self.fill_data, ppw)),
+				draw_en.eq(-1),
+			]
+		with m.Else():
+			m.d.comb += [
+				draw_addr.eq(address(self.coords_w)),
+				draw_data.eq(Repl(self.w_data, ppw)),
+				draw_en.eq(Mux(self.write, self.w_mask, 0)),
+			]
 
 		m.d.comb += [
-			fb0.rp.en.eq(~selected),
-			fb1.rp.en.eq(selected),
+			fb0.rp.en.eq(~selected_r),
+			fb1.rp.en.eq(selected_r),
 		]
 
+		# drawing goes to the selected buffer, fills to the one being displayed
+		# the whole word is cleared once its last pixel has been read
 		with m.If(selected):
 			m.d.comb += [
-				fb0.wp.addr.eq(self.coords_w.xy),
-				fb0.wp.data.eq(self.w_data),
-				fb0.wp.en.eq(self.write),
-				fb1.rp.addr.eq(self.coords_r.xy),
-				fb1.wp.addr.eq(self.coords_r.xy),
-				fb1.wp.data.eq(self.fill_data),
-				fb1.wp.en.eq(self.read_fill),
-				self.color.rgb.eq(self.palette[fb1.rp.data]),
+				fb0.wp.addr.eq(draw_addr),
+				fb0.wp.data.eq(draw_data),
+				fb0.wp.en.eq(draw_en),
+				fb1.wp.addr.eq(address(fill_coords)),
+				fb1.wp.data.eq(Repl(self.fill_data, ppw)),
+				fb1.wp.en.eq(Repl(fill, ppw)),
+			]
+		with m.Else():
+			m.d.comb += [
+				fb1.wp.addr.eq(draw_addr),
+				fb1.wp.data.eq(draw_data),
+				fb1.wp.en.eq(draw_en),
+				fb0.wp.addr.eq(address(fill_coords)),
+				fb0.wp.data.eq(Repl(self.fill_data, ppw)),
+				fb0.wp.en.eq(Repl(fill, ppw)),
+			]
+
+		with m.If(selected_r):
+			m.d.comb += [
+				fb1.rp.addr.eq(address(self.coords_r)),
+				self.color.rgb.eq(self.palette[fb1.rp.data.word_select(read_select, 3)]),
 			]
 		with m.Else():
 			m.d.comb += [
-				fb1.wp.addr.eq(self.coords_w.xy),
-				fb1.wp.data.eq(self.w_data),
-				fb1.wp.en.eq(self.write),
-				fb0.rp.addr.eq(self.coords_r.xy),
-				fb0.wp.addr.eq(self.coords_r.xy),
-				fb0.wp.data.eq(self.fill_data),
-				fb0.wp.en.eq(self.read_fill),
-				self.color.rgb.eq(self.palette[fb0.rp.data]),
+				fb0.rp.addr.eq(address(self.coords_r)),
+				self.color.rgb.eq(self.palette[fb0.rp.data.word_select(read_select, 3)]),
 			]
 
 		return m
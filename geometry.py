@@ -1,8 +1,14 @@
+import numpy as np
+from collections import OrderedDict
+
+import cost
+
+
 class Point():
 	def __init__(self, x=0, y=0):
 		self.x = x
 		self.y = y
-	
+
 	@property
 	def xy(self):
 		return (self.x, self.y)
@@ -12,18 +18,161 @@ class Segment():
 	def __init__(self, start:Point, end:Point):
 		self.start = start
 		self.end = end
-	
+
 	def serialize(self):
 		return (*self.start.xy, *self.end.xy)
 
 
-class Mesh():
+def clip(segments, width=160, height=120):
+	# Liang-Barsky against the framebuffer for a whole (E,4) array of x y x y.
+	# Returns integer pixel coordinates for only the drawable segments: those
+	# entirely off screen or of zero length are dropped.
+	seg = np.asarray(segments, dtype=float).reshape(-1, 4)
+	x0, y0, x1, y1 = seg.T
+	dx = x1 - x0
+	dy = y1 - y0
+
+	# one row per edge of the rectangle: left, right, top, bottom
+	p = np.stack([-dx, dx, -dy, dy])
+	q = np.stack([x0, (width-1) - x0, y0, (height-1) - y0])
+	with np.errstate(divide="ignore", invalid="ignore"):
+		r = q / p
+	t0 = np.where(p < 0, r, 0).max(axis=0)
+	t1 = np.where(p > 0, r, 1).min(axis=0)
+
+	outside = ((p == 0) & (q < 0)).any(axis=0)  # parallel to and beyond an edge
+	keep = (t0 <= t1) & ~outside
+
+	clipped = np.stack([x0 + t0*dx, y0 + t0*dy, x0 + t1*dx, y0 + t1*dy], axis=1)[keep]
+	clipped = np.rint(clipped)
+	np.clip(clipped[:, 0::2], 0, width-1, out=clipped[:, 0::2])
+	np.clip(clipped[:, 1::2], 0, height-1, out=clipped[:, 1::2])
+	# zero length once rounded to pixels, which includes sub-pixel ones
+	clipped = clipped[(clipped[:, :2] != clipped[:, 2:]).any(axis=1)]
+	return clipped.astype(np.uint8)
+
+
+def check_segments(segments, coord_max=0xff):
+	# an (N,4) array of x y x y as the bytes the device stores, for uploads,
+	# rounded to the nearest pixel
+	segments = np.rint(np.asarray(segments, dtype=float)).reshape(-1, 4)
+	if ((segments < 0) | (segments > coord_max)).any():
+		raise ValueError(f"Coordinates must be in the range of 0 to {coord_max}")
+	return segments.astype(np.uint8)
+
+
+class ArrayMesh():
+	# points is an (N,2) array of x y, edges an (E,2) array of point indices
+	lod_levels = (0.5, 1, 2, 4, 8)  # tolerances lod_for_budget picks from, finest first
+	lod_cache_size = 8  # simplified meshes kept per mesh
+
+	def __init__(self, points, edges):
+		self.points = np.asarray(points).reshape(-1, 2)
+		self.edges = np.asarray(edges, dtype=np.intp).reshape(-1, 2)
+		self._lods = OrderedDict()  # tolerance -> simplified mesh, least recently used first
+
+	def arrays(self):
+		# (N,2) points and (E,2) edges, what all the methods work on
+		return self.points, self.edges
+
+	def _like(self, points, edges):
+		# a mesh of the same kind from arrays, for the transforms to return
+		return type(self)(points, edges)
+
+	def segments(self):
+		# (E,4) array of x y x y, one row per edge
+		points, edges = self.arrays()
+		return points[edges].reshape(-1, 4)
+
+	def serialize(self):
+		segments = np.rint(self.segments())
+		if ((segments < 0) | (segments > 0xff)).any():
+			raise ValueError("Coordinates must be in the range of 0 to 255, see clip()")
+		return segments.astype(np.uint8)
+
+	def translate(self, dx, dy):
+		points, edges = self.arrays()
+		return self._like(points + (dx, dy), edges)
+
+	def scale(self, sx, sy=None):
+		if sy is None:
+			sy = sx
+		points, edges = self.arrays()
+		return self._like(points * (sx, sy), edges)
+
+	def rotate(self, angle, center=(0, 0)):
+		c, s = np.cos(angle), np.sin(angle)
+		rotation = np.array([[c, s], [-s, c]])  # applied to row vectors
+		points, edges = self.arrays()
+		return self._like((points - center) @ rotation + center, edges)
+
+	def simplify(self, tolerance):
+		# Merge the points within each `tolerance` sized cell of a grid, in the
+		# mesh's own units, into their average. Edges that collapse to a point or
+		# now repeat another are dropped, and so are the points no edge uses any
+		# more.
+		if tolerance <= 0:
+			return self
+		points, edges = self.arrays()
+		cells = np.floor(points / tolerance).astype(np.int64)
+		_, cluster = np.unique(cells, axis=0, return_inverse=True)
+		cluster = cluster.reshape(-1)
+		counts = np.bincount(cluster, minlength=cluster.max(initial=-1) + 1)
+		merged = np.stack([np.bincount(cluster, weights=points[:, i], minlength=len(counts))
+			for i in range(2)], axis=1)
+		merged /= counts[:, None]
+
+		edges = cluster[edges]
+		edges = edges[edges[:, 0] != edges[:, 1]]
+		edges = np.unique(np.sort(edges, axis=1), axis=0)
+		used, edges = np.unique(edges, return_inverse=True)
+		return self._like(merged[used], edges.reshape(-1, 2))
+
+	def lod(self, tolerance, scale=1):
+		# Call this on the mesh as modeled, then place the result: the cache lives
+		# on this mesh, and every transform returns a new one. `tolerance` is in
+		# framebuffer pixels and `scale` the pixels per unit of the placement.
+		# The tolerance in the mesh's units is rounded down to a power of two, so
+		# an animated scale keeps hitting the same few levels.
+		if tolerance <= 0:
+			return self
+		level = 2.0 ** np.floor(np.log2(tolerance / scale))
+		if level in self._lods:
+			self._lods.move_to_end(level)
+		else:
+			self._lods[level] = self.simplify(level)
+			if len(self._lods) > self.lod_cache_size:
+				self._lods.popitem(last=False)
+		return self._lods[level]
+
+	def lod_for_budget(self, budget=None, drawers=1, scale=1):
+		# The most detailed of lod_levels whose segments, placed at `scale`,
+		# LineSet draws within `budget` cycles, a whole frame by default, or the
+		# coarsest level if none do. Scenes with several meshes give each its
+		# share. Rotating the placement changes the cost by at most a factor of
+		# sqrt(2).
+		if budget is None:
+			budget = cost.frame_budget()
+		for tolerance in (0, *self.lod_levels):
+			mesh = self.lod(tolerance, scale)
+			if cost.frame_cost(mesh.segments() * scale, drawers) <= budget:
+				break
+		return mesh
+
+
+class Mesh(ArrayMesh):
+	# Kept for older callers: points stays the list of Points it was given and
+	# edges the list of index pairs, and serialize returns a list of tuples.
+	# The array methods convert them on every call, so edits to the lists show.
 	def __init__(self, points=[], edges=[]):
-		self.points = points
-		self.edges = edges
-	
+		self.points = [p if isinstance(p, Point) else Point(*p) for p in points]
+		self.edges = [tuple(e) for e in np.asarray(edges, dtype=np.intp).reshape(-1, 2).tolist()]
+		self._lods = OrderedDict()
+
+	def arrays(self):
+		# the points' own type, so serialize gives back the ints it was given
+		points = np.array([p.xy for p in self.points]).reshape(-1, 2)
+		return points, np.asarray(self.edges, dtype=np.intp).reshape(-1, 2)
+
 	def serialize(self):
-		segments = []
-		for edge in self.edges:
-			segments.append(Segment(self.points[edge[0]], self.points[edge[1]]))
-		return [s.serialize() for s in segments]
+		return [tuple(s) for s in self.segments().tolist()]
@@ -1,19 +1,24 @@
 from amaranth import *
-from structures import Coords, Color
+from amaranth.lib.fifo import SyncFIFO
+from structures import Coords, Color, Affine
 
 class _LineDrawer(Elaboratable):
-	def __init__(self, max_x, max_y):
+	def __init__(self, max_x, max_y, span=4):
 		self.max_x = max_x
 		self.max_y = max_y
+		self.span = span  # pixels per framebuffer word
 
 		# in
 		self.endpoints = [Coords(max_x, max_y), Coords(max_x, max_y)]
-		self.start = Signal()
+		self.start = Signal()  # endpoints are taken on the same cycle while idle
+		self.stall = Signal()  # hold the current pixel, another drawer has the write port
 
 		# out
 		self.coords = Coords(max_x, max_y)
+		self.mask = Signal(span)  # pixels of the word at coords written this cycle
 		self.write = Signal()
 		self.done = Signal()
+		self.idle = Signal()
 
 	def elaborate(self, _platform):
 		m = Module()
@@ -25,13 +30,61 @@ class _LineDrawer(Elaboratable):
 		dy = Signal(range(-self.max_y, self.max_y))
 		sy = Signal(range(-self.max_y, self.max_y))
 		error = Signal(range(-self.max_x<<1, self.max_x<<1))
+		# x steps on every pixel of lines at least as wide as they are tall, so a
+		# run of pixels in the same row and word can go out in one cycle
+		shallow = Signal()
+		dy_times = [Signal(signed(12), name=f"dy_times{k}") for k in range(self.span)]
 
 		x = Signal(range(-self.max_x, self.max_x))
 		y = Signal(range(-self.max_y, self.max_y))
 		m.d.comb += self.coords.x.eq(x)
 		m.d.comb += self.coords.y.eq(y)
 
-		with m.FSM(domain="px", reset="wait"):
+		# worked out straight from the endpoints so drawing starts on the next cycle
+		start_dx = Signal.like(dx)
+		start_dy = Signal.like(dy)
+		m.d.comb += [
+			start_dx.eq(Mux(self.endpoints[0].x > self.endpoints[1].x,
+				self.endpoints[0].x - self.endpoints[1].x,
+				self.endpoints[1].x - self.endpoints[0].x)),
+			start_dy.eq(Mux(self.endpoints[0].y > self.endpoints[1].y,
+				self.endpoints[1].y - self.endpoints[0].y,
+				self.endpoints[0].y - self.endpoints[1].y)),
+		]
+
+		# Lane k is the pixel k steps along x from the current one. Without a y
+		# step in between its error is error + k*dy, so every lane's step
+		# decisions are worked out side by side instead of one after another.
+		lane_x = [Signal(range(-self.max_x - self.span, self.max_x + self.span), name=f"lane_x{k}")
+			for k in range(self.span)]
+		lane_error = [Signal(signed(12), name=f"lane_error{k}") for k in range(self.span)]
+		lane_step_y = [Signal(name=f"lane_step_y{k}") for k in range(self.span)]
+		lane_done = [Signal(name=f"lane_done{k}") for k in range(self.span)]
+		lane_last = [Signal(name=f"lane_last{k}") for k in range(self.span)]
+		lane_on = [Signal(name=f"lane_on{k}") for k in range(self.span)]
+		word_bits = (self.span - 1).bit_length()  # span is a power of 2
+		for k in range(self.span):
+			m.d.comb += [
+				lane_x[k].eq(Mux(sx[-1], x - k, x + k)),
+				lane_error[k].eq(error + dy_times[k]),
+				lane_step_y[k].eq(lane_error[k]<<1 <= dx),
+				lane_done[k].eq((lane_x[k] == end.x) & (~lane_step_y[k] | (y == end.y))),
+			]
+			if k == self.span - 1:
+				m.d.comb += lane_last[k].eq(1)
+			else:
+				next_x = Mux(sx[-1], x - (k+1), x + (k+1))
+				leaves_word = next_x[word_bits:] != x[word_bits:]
+				m.d.comb += lane_last[k].eq(~shallow | lane_step_y[k] | lane_done[k] | leaves_word)
+			if k == 0:
+				m.d.comb += lane_on[k].eq(1)
+			else:
+				m.d.comb += lane_on[k].eq(lane_on[k-1] & ~lane_last[k-1])
+		for p in range(self.span):
+			m.d.comb += self.mask[p].eq(
+				Cat(lane_on[k] & (lane_x[k][:word_bits] == p) for k in range(self.span)).any())
+
+		with m.FSM(domain="px", reset="wait") as fsm:
 			with m.State("wait"):
 				m.d.px += self.write.eq(0)
 				m.d.px += self.done.eq(0)
@@ -41,54 +94,88 @@ class _LineDrawer(Elaboratable):
 						end.y.eq(self.endpoints[1].y),
 						x.eq(self.endpoints[0].x),
 						y.eq(self.endpoints[0].y),
+						dx.eq(start_dx),
+						dy.eq(start_dy),
+						error.eq(start_dx + start_dy),
+						sx.eq(Mux(self.endpoints[0].x > self.endpoints[1].x, -1, 1)),
+						sy.eq(Mux(self.endpoints[0].y > self.endpoints[1].y, -1, 1)),
+						shallow.eq(start_dx + start_dy >= 0),
+						self.write.eq(1),
 					]
-					with m.If(self.endpoints[0].x > self.endpoints[1].x):
-						m.d.px += sx.eq(-1)
-						m.d.px += dx.eq(self.endpoints[0].x - self.endpoints[1].x)
-					with m.Else():
-						m.d.px += sx.eq(1)
-						m.d.px += dx.eq(self.endpoints[1].x - self.endpoints[0].x)
-					
-					with m.If(self.endpoints[0].y > self.endpoints[1].y):
-						m.d.px += sy.eq(-1)
-						m.d.px += dy.eq(self.endpoints[1].y - self.endpoints[0].y)
-					with m.Else():
-						m.d.px += sy.eq(1)
-						m.d.px += dy.eq(self.endpoints[0].y - self.endpoints[1].y)
-					m.next = "calculate"
-
-			with m.State("calculate"):
-				m.d.px += [
-					error.eq(dx + dy),
-					self.write.eq(1)
-				]
-				m.next = "draw"
+					m.d.px += [dy_times[k].eq(start_dy * k) for k in range(self.span)]
+					m.next = "draw"
 
 			with m.State("draw"):
-				m.d.px += self.write.eq(1)
-				with m.If((x == end.x) & (y == end.y)):
-					m.d.px += [self.write.eq(0), self.done.eq(1)]
-					m.next = "wait"
-
-				with m.If((error<<1 >= dy) & (error<<1 <= dx)):
-					m.d.px += error.eq(error + dy + dx)
-					m.d.px += [x.eq(x + sx), y.eq(y + sy)]
-				with m.Elif(error<<1 >= dy):
-					with m.If(x == end.x):
-						m.d.px += [self.write.eq(0), self.done.eq(1)]
-						m.next = "wait"
-					m.d.px += error.eq(error + dy)
-					m.d.px += x.eq(x + sx)
-				with m.Elif(error<<1 <= dx):
-					with m.If(y == end.y):
+				with m.If(~self.stall & shallow):
+					m.d.px += self.write.eq(1)
+					# continue after the last lane out this cycle
+					for k in range(self.span):
+						with (m.If if k == 0 else m.Elif)(lane_last[k]):
+							m.d.px += [
+								x.eq(Mux(sx[-1], lane_x[k] - 1, lane_x[k] + 1)),
+								error.eq(lane_error[k] + dy + Mux(lane_step_y[k], dx, 0)),
+								y.eq(Mux(lane_step_y[k], y + sy, y)),
+							]
+							with m.If(lane_done[k]):
+								m.d.px += [self.write.eq(0), self.done.eq(1)]
+								m.next = "wait"
+
+				with m.Elif(~self.stall):
+					m.d.px += self.write.eq(1)
+					with m.If((x == end.x) & (y == end.y)):
 						m.d.px += [self.write.eq(0), self.done.eq(1)]
 						m.next = "wait"
-					m.d.px += error.eq(error + dx)
-					m.d.px += y.eq(y + sy)
+
+					with m.If((error<<1 >= dy) & (error<<1 <= dx)):
+						m.d.px += error.eq(error + dy + dx)
+						m.d.px += [x.eq(x + sx), y.eq(y + sy)]
+					with m.Elif(error<<1 >= dy):
+						with m.If(x == end.x):
+							m.d.px += [self.write.eq(0), self.done.eq(1)]
+							m.next = "wait"
+						m.d.px += error.eq(error + dy)
+						m.d.px += x.eq(x + sx)
+					with m.Elif(error<<1 <= dx):
+						with m.If(y == end.y):
+							m.d.px += [self.write.eq(0), self.done.eq(1)]
+							m.next = "wait"
+						m.d.px += error.eq(error + dx)
+						m.d.px += y.eq(y + sy)
+
+		m.d.comb += self.idle.eq(fsm.ongoing("wait"))
 
 		return m
 
 
+def _spram(m, name, platform, address, data_in, write, data_out):
+	if platform is None:
+		# behavioral model so the design can run in the simulator
+		mem = Memory(width=16, depth=2**14)
+		m.submodules[name + "_r"] = rp = mem.read_port(domain="px", transparent=False)
+		m.submodules[name + "_w"] = wp = mem.write_port(domain="px")
+		m.d.comb += [
+			rp.addr.eq(address),
+			data_out.eq(rp.data),
+			wp.addr.eq(address),
+			wp.data.eq(data_in),
+			wp.en.eq(write),
+		]
+	else:
+		m.submodules[name] = Instance(
+			'SB_SPRAM256KA',
+			i_ADDRESS = address,
+			i_DATAIN = data_in,
+			i_MASKWREN = Const(0b1111, 4),
+			i_WREN = write,
+			i_CHIPSELECT = 1,
+			i_CLOCK = ClockSignal("px"),
+			i_STANDBY = 0,
+			i_SLEEP = 0,
+			i_POWEROFF = 1,
+			o_DATAOUT = data_out
+		)
+
+
 class _SegmentMemory(Elaboratable):
 	def __init__(self, max_x, max_y):
 		from math import log, ceil
@@ -97,14 +184,15 @@ class _SegmentMemory(Elaboratable):
 			exit(1)
 		
 		# in
-		self.index = Signal(14)
+		# one index per endpoint, they differ when looking up the vertices of an edge
+		self.index = [Signal(14, name="index_start"), Signal(14, name="index_end")]
 		self.endpoints_in = [Coords(max_x, max_y), Coords(max_x, max_y)]
 		self.write = Signal()
 
 		# out
 		self.endpoints_out = [Coords(max_x, max_y), Coords(max_x, max_y)]
 	
-	def elaborate(self, _platform):
+	def elaborate(self, platform):
 		m = Module()
 
 		start_data_in_padded = Signal(16)
@@ -120,33 +208,36 @@ class _SegmentMemory(Elaboratable):
 			self.endpoints_out[1].xy.eq(end_data_out_padded),
 		]
 
-		m.submodules.start = Instance(
-			'SB_SPRAM256KA',
-			i_ADDRESS = self.index,
-			i_DATAIN = start_data_in_padded,
-			i_MASKWREN = Const(0b1111, 4),
-			i_WREN = self.write,
-			i_CHIPSELECT = 1,
-			i_CLOCK = ClockSignal("px"),
-			i_STANDBY = 0,
-			i_SLEEP = 0,
-			i_POWEROFF = 1,
-			o_DATAOUT = start_data_out_padded
-		)
+		_spram(m, "start", platform, self.index[0], start_data_in_padded, self.write, start_data_out_padded)
+		_spram(m, "end", platform, self.index[1], end_data_in_padded, self.write, end_data_out_padded)
 
-		m.submodules.end = Instance(
-			'SB_SPRAM256KA',
-			i_ADDRESS = self.index,
-			i_DATAIN = end_data_in_padded,
-			i_MASKWREN = Const(0b1111, 4),
-			i_WREN = self.write,
-			i_CHIPSELECT = 1,
-			i_CLOCK = ClockSignal("px"),
-			i_STANDBY = 0,
-			i_SLEEP = 0,
-			i_POWEROFF = 1,
-			o_DATAOUT = end_data_out_padded
-		)
+		return m
+
+
+class _EdgeMemory(Elaboratable):
+	# Vertex index pairs for indexed ranges, in the other two SPRAMs. Vertices
+	# are written to both halves of segment memory, so the start of an edge is
+	# read from one and its end from the other in the same cycle.
+	def __init__(self):
+		# in
+		self.index = Signal(14)
+		self.vertices_in = [Signal(14), Signal(14)]
+		self.write = Signal()
+
+		# out
+		self.vertices_out = [Signal(14), Signal(14)]
+
+	def elaborate(self, platform):
+		m = Module()
+
+		for i, name in enumerate(["edge_start", "edge_end"]):
+			data_in_padded = Signal(16, name=f"{name}_data_in_padded")
+			data_out_padded = Signal(16, name=f"{name}_data_out_padded")
+			m.d.comb += [
+				data_in_padded.eq(self.vertices_in[i]),
+				self.vertices_out[i].eq(data_out_padded),
+			]
+			_spram(m, name, platform, self.index, data_in_padded, self.write, data_out_padded)
 
 		return m
 
@@ -157,64 +248,183 @@ class _SegmentAccessArbiter(Elaboratable):
 		self.max_y = max_y
 
 		# line renderer in
-		self.index_read = Signal(14)
+		self.index_read = [Signal(14, name="index_read_start"), Signal(14, name="index_read_end")]
 		self.request_read = Signal()
+		self.edge_index_read = Signal(14)
+		self.request_edge_read = Signal()
 
 		# UART in
 		self.index_write = Signal(14)
 		self.request_write = Signal()
+		self.edge_write = Signal()  # write vertices_in to edge memory instead
 		self.endpoints_in = [Coords(max_x, max_y), Coords(max_x, max_y)]
+		self.vertices_in = [Signal(14), Signal(14)]
 
 		# out
 		self.endpoints_out = [Coords(max_x, max_y), Coords(max_x, max_y)]
+		self.vertices_out = [Signal(14), Signal(14)]
 		self.write_done = Signal()
+		self.write_pending = Signal()  # a write is waiting for a cycle without reads
 	
 	def elaborate(self, _platform):
 		m = Module()
 		m.submodules.memory = mem = _SegmentMemory(self.max_x, self.max_y)
+		m.submodules.edges = edges = _EdgeMemory()
 
 		pending_write = Signal()
+		pending_edge = Signal()
 		pending_index = Signal(14)
 		pending_data = [Coords(self.max_x, self.max_y), Coords(self.max_x, self.max_y)]
+		pending_vertices = [Signal(14), Signal(14)]
 
 		# reading gets priority in the edge case that both happen simultaneously
 		m.d.px += self.write_done.eq(0)
 		m.d.px += mem.write.eq(0)
+		m.d.px += edges.write.eq(0)
 		with m.If(self.request_read):
-			m.d.px += mem.index.eq(self.index_read)
-		with m.Elif(pending_write):
+			m.d.px += mem.index[0].eq(self.index_read[0])
+			m.d.px += mem.index[1].eq(self.index_read[1])
+		with m.Elif(pending_write & ~pending_edge):
 			m.d.px += [
 				pending_write.eq(0),
 				self.write_done.eq(1),
 				mem.write.eq(1),
-				mem.index.eq(pending_index),
+				mem.index[0].eq(pending_index),
+				mem.index[1].eq(pending_index),
 				mem.endpoints_in[0].xy.eq(pending_data[0].xy),
 				mem.endpoints_in[1].xy.eq(pending_data[1].xy),
 			]
+
+		with m.If(self.request_edge_read):
+			m.d.px += edges.index.eq(self.edge_index_read)
+		with m.Elif(pending_write & pending_edge):
+			m.d.px += [
+				pending_write.eq(0),
+				self.write_done.eq(1),
+				edges.write.eq(1),
+				edges.index.eq(pending_index),
+				edges.vertices_in[0].eq(pending_vertices[0]),
+				edges.vertices_in[1].eq(pending_vertices[1]),
+			]
 		
 		m.d.comb += self.endpoints_out[0].xy.eq(mem.endpoints_out[0].xy)
 		m.d.comb += self.endpoints_out[1].xy.eq(mem.endpoints_out[1].xy)
+		m.d.comb += self.vertices_out[0].eq(edges.vertices_out[0])
+		m.d.comb += self.vertices_out[1].eq(edges.vertices_out[1])
+		m.d.comb += self.write_pending.eq(pending_write)
 
 		with m.If(self.request_write):
 			m.d.px += pending_write.eq(1)
+			m.d.px += pending_edge.eq(self.edge_write)
 			m.d.px += pending_index.eq(self.index_write)
 			m.d.px += pending_data[0].xy.eq(self.endpoints_in[0].xy)
 			m.d.px += pending_data[1].xy.eq(self.endpoints_in[1].xy)
+			m.d.px += pending_vertices[0].eq(self.vertices_in[0])
+			m.d.px += pending_vertices[1].eq(self.vertices_in[1])
 
 		return m
 
 
-class LineSet(Elaboratable):
+class _AffineTransform(Elaboratable):
+	# Both endpoints of one segment per cycle through an Affine matrix, with
+	# 2 cycles of latency. The multiplies are 16x9 bits so they map onto the
+	# SB_MAC16 blocks. Segments entirely past one edge of the screen come out
+	# with visible low, the others are clamped to the screen.
 	def __init__(self, max_x, max_y):
 		self.max_x = max_x
 		self.max_y = max_y
 
+		# in
+		self.endpoints_in = [Coords(max_x, max_y), Coords(max_x, max_y)]
+		self.matrix = Affine()
+		self.valid_in = Signal()
+		self.keep_in = Signal()  # low to let a slot through without drawing it
+
+		# out
+		self.endpoints_out = [Coords(max_x, max_y), Coords(max_x, max_y)]
+		self.valid_out = Signal()
+		self.visible = Signal()
+
+	def elaborate(self, _platform):
+		m = Module()
+		matrix = self.matrix
+
+		# stage 1: the products, and everything else delayed to match
+		tx = Signal.like(matrix.tx)
+		ty = Signal.like(matrix.ty)
+		valid = Signal()
+		keep = Signal()
+		m.d.px += [tx.eq(matrix.tx), ty.eq(matrix.ty), valid.eq(self.valid_in), keep.eq(self.keep_in)]
+
+		products = []
+		for i, p in enumerate(self.endpoints_in):
+			ax, by, cx, dy = (Signal(signed(25), name=f"{n}{i}") for n in ("ax", "by", "cx", "dy"))
+			m.d.px += [
+				ax.eq(matrix.a * p.x),
+				by.eq(matrix.b * p.y),
+				cx.eq(matrix.c * p.x),
+				dy.eq(matrix.d * p.y),
+			]
+			products.append((ax, by, cx, dy))
+
+		# stage 2: sums, then cull or clamp
+		left = []
+		right = []
+		above = []
+		below = []
+		for i, (ax, by, cx, dy) in enumerate(products):
+			x = Signal(signed(20), name=f"x{i}")
+			y = Signal(signed(20), name=f"y{i}")
+			m.d.comb += [
+				x.eq(((ax + by) >> Affine.fraction_bits) + tx),
+				y.eq(((cx + dy) >> Affine.fraction_bits) + ty),
+			]
+			left.append(x < 0)
+			right.append(x >= self.max_x)
+			above.append(y < 0)
+			below.append(y >= self.max_y)
+
+			out = self.endpoints_out[i]
+			m.d.px += out.x.eq(Mux(x < 0, 0, Mux(x >= self.max_x, self.max_x - 1, x)))
+			m.d.px += out.y.eq(Mux(y < 0, 0, Mux(y >= self.max_y, self.max_y - 1, y)))
+
+		outside = Cat(Cat(edge).all() for edge in (left, right, above, below)).any()
+		m.d.px += [
+			self.valid_out.eq(valid),
+			self.visible.eq(keep & ~outside),
+		]
+
+		return m
+
+
+class LineSet(Elaboratable):
+	def __init__(self, max_x, max_y, drawers=1, max_ranges=1, span=4):
+		self.max_x = max_x
+		self.max_y = max_y
+		self.drawers = drawers  # more drawers draw more lines per frame, for more LUTs
+		self.span = span  # pixels per framebuffer word, drawn together along rows
+		self.max_ranges = max_ranges
+
 		# UART in
-		self.index_start = Signal(14)
-		self.index_end = Signal(14, reset=10)
+		# display list: ranges 0 to range_count-1 are drawn in order every frame
+		self.range_starts = Array(Signal(14, name=f"range_start{i}") for i in range(max_ranges))
+		self.range_ends = Array(Signal(14, name=f"range_end{i}", reset=10 if i == 0 else 0)
+			for i in range(max_ranges))
+		self.range_count = Signal(range(max_ranges + 1), reset=1)
+		self.range_transforms = [Affine(name=f"range_transform{i}") for i in range(max_ranges)]
+		# indexed ranges count through edge memory instead of segment memory
+		self.range_indexed = Array(Signal(name=f"range_indexed{i}") for i in range(max_ranges))
+		# instanced ranges are drawn once per (dx, dy) offset, read from edge
+		# memory starting at the base index. A count of 0 draws the range once.
+		self.range_instance_bases = Array(Signal(14, name=f"range_instance_base{i}")
+			for i in range(max_ranges))
+		self.range_instance_counts = Array(Signal(14, name=f"range_instance_count{i}")
+			for i in range(max_ranges))
 		self.index_write = Signal(14)
 		self.request_write = Signal()
+		self.edge_write = Signal()  # vertices_in go to edge memory at index_write
 		self.endpoints_in = [Coords(max_x, max_y), Coords(max_x, max_y)]
+		self.vertices_in = [Signal(14), Signal(14)]
 
 		# vga in
 		self.start = Signal()
@@ -222,52 +432,170 @@ class LineSet(Elaboratable):
 		# out
 		self.write_done = Signal()  # uart out
 		self.coords = Coords(max_x, max_y)  # fb out
+		self.mask = Signal(span)  # fb out, pixels of the word at coords
 		self.write = Signal()  # fb out
+		self.busy = Signal()  # still drawing the current frame
+		self.drawn = Signal()  # a segment was handed to a drawer
 	
 	def elaborate(self, _platform):
 		m = Module()
-		counter = Signal(self.index_start.width)
+		counter = Signal(14)
+		range_no = Signal(range(self.max_ranges))
 
 		m.submodules.mem = arb = _SegmentAccessArbiter(self.max_x, self.max_y)
-
-		m.submodules.line = line = _LineDrawer(self.max_x, self.max_y)
 		m.d.comb += [
-			self.coords.xy.eq(line.coords.xy),
-			self.write.eq(line.write),
-			line.endpoints[0].xy.eq(arb.endpoints_out[0].xy),
-			line.endpoints[1].xy.eq(arb.endpoints_out[1].xy),
-
 			arb.index_write.eq(self.index_write),
 			arb.request_write.eq(self.request_write),
+			arb.edge_write.eq(self.edge_write),
 			arb.endpoints_in[0].xy.eq(self.endpoints_in[0].xy),
 			arb.endpoints_in[1].xy.eq(self.endpoints_in[1].xy),
+			arb.vertices_in[0].eq(self.vertices_in[0]),
+			arb.vertices_in[1].eq(self.vertices_in[1]),
 			self.write_done.eq(arb.write_done),
 		]
 
-		m.d.px += line.start.eq(0)
-		m.d.px += arb.request_read.eq(0)
-		with m.FSM(reset="IDLE", domain="px"):
-			with m.State("IDLE"):
-				with m.If(self.start):
-					m.d.px += counter.eq(self.index_start)
-					m.d.px += arb.index_read.eq(self.index_start)
-					m.d.px += arb.request_read.eq(1)  # how many cycles until the result is available?
-					m.next = "START"
-			with m.State("START"):
-				m.next = "WAIT"
-			with m.State("WAIT"):
-				with m.If(counter != 0):  # don't render line with index 0
-					m.d.px += line.start.eq(1)
-				m.next = "DRAW"
-			with m.State("DRAW"):
-				with m.If(line.done | (counter == 0)):
-					with m.If(counter == self.index_end):
-						m.d.px += counter.eq(self.index_start)
-						m.next = "IDLE"
-					with m.Else():
-						m.d.px += counter.eq(counter + 1)
-						m.d.px += arb.index_read.eq(counter + 1)
-						m.d.px += arb.request_read.eq(1)
-						m.next = "START"
+		m.submodules.transform = xf = _AffineTransform(self.max_x, self.max_y)
+
+		# transformed segments, handed to a drawer as soon as one is free
+		endpoints = [Coords(self.max_x, self.max_y), Coords(self.max_x, self.max_y)]
+		m.submodules.queue = queue = DomainRenamer("px")(
+			SyncFIFO(width=2*endpoints[0].width, depth=8, fwft=True))
+		m.d.comb += [
+			queue.w_data.eq(Cat(xf.endpoints_out[0].xy, xf.endpoints_out[1].xy)),
+			queue.w_en.eq(xf.valid_out & xf.visible),
+			Cat(endpoints[0].xy, endpoints[1].xy).eq(queue.r_data),
+		]
+
+		lines = []
+		for i in range(self.drawers):
+			m.submodules[f"line{i}"] = line = _LineDrawer(self.max_x, self.max_y, self.span)
+			m.d.comb += [
+				line.endpoints[0].xy.eq(endpoints[0].xy),
+				line.endpoints[1].xy.eq(endpoints[1].xy),
+			]
+			lines.append(line)
+
+		# one framebuffer write per cycle: the lowest numbered drawer wins and
+		# the others hold their pixel until the port is free
+		taken = C(0)
+		for line in lines:
+			with m.If(line.write & ~taken):
+				m.d.comb += self.coords.xy.eq(line.coords.xy)
+				m.d.comb += self.mask.eq(line.mask)
+			m.d.comb += line.stall.eq(line.write & taken)
+			taken = taken | line.write
+		m.d.comb += self.write.eq(taken)
+
+		# segments go out in order to whichever drawer is free first
+		consume = Signal()
+		for i, line in enumerate(lines):
+			with (m.If if i == 0 else m.Elif)(queue.r_rdy & line.idle):
+				m.d.comb += [line.start.eq(1), consume.eq(1)]
+		m.d.comb += [queue.r_en.eq(consume), self.drawn.eq(consume)]
+
+		# Reading the next segments while the current ones draw. Every index is
+		# first looked up in edge memory, and 3 cycles later the endpoints are
+		# read from segment memory, at the edge's vertices for indexed ranges and
+		# at the index itself otherwise. They come out 3 cycles after that, and
+		# out of the transform 2 cycles later. A read is issued every cycle as
+		# long as the queue has room for everything in flight, except when the
+		# UART has a write waiting, which then gets the memory once the reads
+		# already issued are through.
+		fetching = Signal()  # indices left to read this frame
+		in_flight = Signal(range(queue.depth + 1))
+		issue = Signal()
+		lookup = Signal()  # edge memory data is valid, read the endpoints
+		# per read, delayed until its data comes out of edge and then segment memory
+		tag_valid = Signal(6)
+		tag_skip = Signal(6)  # index 0, which is never drawn
+		tag_offset = Signal(6)  # an instance offset read, not a segment
+		tag_indexed = Signal(3)
+		tag_range = [Signal.like(range_no, name=f"tag_range{i}") for i in range(6)]
+		tag_index = [Signal.like(counter, name=f"tag_index{i}") for i in range(3)]
+		# edge memory data carried on to where the offset is used
+		tag_data = [Signal(28, name=f"tag_data{i}") for i in range(3)]
+
+		# Each instance starts with a read of its offset, which takes a slot in
+		# the pipeline like a segment but only updates the offset added to the
+		# segments behind it.
+		instance = Signal(14)  # edge memory index of the current offset
+		instances_left = Signal(14)
+		offset_next = Signal()  # the next read is an offset
+		offset = [Signal(signed(14), name="offset_x"), Signal(signed(14), name="offset_y")]
+
+		def enter_range(n):
+			m.d.px += [
+				range_no.eq(n),
+				counter.eq(self.range_starts[n]),
+				instance.eq(self.range_instance_bases[n]),
+				instances_left.eq(self.range_instance_counts[n]),
+				offset_next.eq(self.range_instance_counts[n] != 0),
+			]
+
+		m.d.comb += issue.eq(fetching & ~arb.write_pending & (queue.level + in_flight < queue.depth))
+		m.d.comb += lookup.eq(tag_valid[2])
+		m.d.px += [
+			arb.request_edge_read.eq(issue),
+			tag_valid.eq(Cat(issue, tag_valid[:-1])),
+			tag_skip.eq(Cat((counter == 0) & ~offset_next, tag_skip[:-1])),
+			tag_offset.eq(Cat(offset_next, tag_offset[:-1])),
+			tag_indexed.eq(Cat(self.range_indexed[range_no], tag_indexed[:-1])),
+			tag_range[0].eq(range_no),
+			tag_index[0].eq(counter),
+			tag_data[0].eq(Cat(arb.vertices_out)),
+		]
+		m.d.px += [tag_range[i].eq(tag_range[i-1]) for i in range(1, len(tag_range))]
+		m.d.px += [tag_index[i].eq(tag_index[i-1]) for i in range(1, len(tag_index))]
+		m.d.px += [tag_data[i].eq(tag_data[i-1]) for i in range(1, len(tag_data))]
+		m.d.px += in_flight.eq(in_flight + issue - xf.valid_out)
+
+		m.d.px += arb.request_read.eq(lookup)
+		with m.If(lookup):
+			for i in range(2):
+				m.d.px += arb.index_read[i].eq(Mux(tag_indexed[-1], arb.vertices_out[i], tag_index[-1]))
+
+		with m.If(tag_valid[-1] & tag_offset[-1]):
+			m.d.px += Cat(offset).eq(tag_data[-1])
+
+		with m.If(issue):
+			m.d.px += arb.edge_index_read.eq(Mux(offset_next, instance, counter))
+			with m.If(offset_next):
+				m.d.px += offset_next.eq(0)
+			with m.Elif(counter != self.range_ends[range_no]):
+				m.d.px += counter.eq(counter + 1)
+			with m.Elif(instances_left > 1):
+				m.d.px += [
+					counter.eq(self.range_starts[range_no]),
+					instance.eq(instance + 1),
+					instances_left.eq(instances_left - 1),
+					offset_next.eq(1),
+				]
+			with m.Elif(range_no + 1 < self.range_count):
+				enter_range(range_no + 1)
+			with m.Else():
+				m.d.px += fetching.eq(0)
+
+		# each segment goes through the matrix of the range it was read for
+		m.d.comb += [
+			xf.endpoints_in[0].xy.eq(arb.endpoints_out[0].xy),
+			xf.endpoints_in[1].xy.eq(arb.endpoints_out[1].xy),
+			xf.valid_in.eq(tag_valid[-1]),
+			xf.keep_in.eq(~tag_skip[-1] & ~tag_offset[-1]),
+		]
+		# plus the instance offset, for instanced ranges
+		instanced = Signal()
+		m.d.comb += instanced.eq(self.range_instance_counts[tag_range[-1]] != 0)
+		for field in ("a", "b", "c", "d"):
+			matrices = Array(getattr(t, field) for t in self.range_transforms)
+			m.d.comb += getattr(xf.matrix, field).eq(matrices[tag_range[-1]])
+		for field, d in zip(("tx", "ty"), offset):
+			matrices = Array(getattr(t, field) for t in self.range_transforms)
+			m.d.comb += getattr(xf.matrix, field).eq(matrices[tag_range[-1]] + Mux(instanced, d, 0))
+
+		m.d.comb += self.busy.eq(fetching | (in_flight != 0) | queue.r_rdy |
+			~Cat(line.idle for line in lines).all())
+		with m.If(self.start & ~self.busy):
+			enter_range(0)
+			m.d.px += fetching.eq(self.range_count != 0)
 		
-		return m
\ No newline at end of file
+		return m
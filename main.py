@@ -1,69 +1,354 @@
 #!/usr/bin/env python3
 from operator import ge
 from serial import Serial
+import numpy as np
 from typing import Tuple
-from time import sleep
-from struct import pack
+from time import sleep, monotonic
+from struct import pack, unpack, calcsize
+from collections import deque
 from top import build_and_run
+from scheduler import FrameScheduler
+from structures import Affine
 
 import uart
 import geometry
+from uart import Stats
+
+
+def pack_edges(pairs):
+	# (N,2) pairs of 14 bit values as the write_edges stream: one 28 bit entry
+	# per pair, little-endian and back to back, so two take 7 bytes
+	pairs = np.asarray(pairs, dtype=np.uint64).reshape(-1, 2) & 0x3fff
+	words = pairs[:, 0] | pairs[:, 1] << np.uint64(14)
+	if len(words) % 2:
+		words = np.r_[words, np.uint64(0)]
+	both = words[0::2] | words[1::2] << np.uint64(28)
+	data = both.astype('<u8').view(np.uint8).reshape(-1, 8)[:, :7].tobytes()
+	return data[:(7*len(pairs) + 1) // 2]
+
 
 class GPUConnection():
 	coord_max = 0xff
 	index_max = 2**14
 	baud = 115200
+	baud_rates = (230400, 460800, 921600, 1000000)  # tried in order by negotiate_baud
+	baud_max_ppm = 20000
+	rx_budget = uart.rx_depth  # unacked bytes the device is guaranteed to hold
+
+	def __init__(self, serial_device="/dev/ttyUSB1", negotiate=False, metrics=None):
+		self.metrics = metrics  # a metrics.GPUMetrics to record into, if any
+		# host copy of the device's segment memory, used to skip unchanged uploads
+		self.shadow = np.zeros((self.index_max, 4), dtype=np.uint8)
+		self.shadow_valid = np.zeros(self.index_max, dtype=bool)
+		self.commits_pending = 0  # set_bounds and set_transform not yet confirmed by commit_ack
 
-	def __init__(self, serial_device="/dev/ttyUSB1"):
 		self.conn = Serial(serial_device, self.baud)
 		if not self.alive:
 			raise ConnectionError("Could not establish serial connection")
+		if negotiate:
+			self.negotiate_baud()
 	
 	def close(self):
 		self.conn.close()
 
+	def reconnect(self):
+		# the board may have been reflashed or reset in the meantime
+		self.conn.close()
+		self.invalidate()
+		self.commits_pending = 0
+		if self.metrics:
+			self.metrics.drop_pending()
+		self.conn.open()
+		if not self.alive:
+			raise ConnectionError("Could not establish serial connection")
+
+	def invalidate(self):
+		self.shadow_valid[:] = False
+
+	def _check_segments(self, segments):
+		return geometry.check_segments(segments, self.coord_max)
+
+	def _mirror(self, indices, segments, ok):
+		if ok:
+			self.shadow[indices] = segments
+			self.shadow_valid[indices] = True
+		else:
+			self.shadow_valid[indices] = False
+
+	def _write(self, command, msg, reply=True):
+		self.conn.write(msg)
+		if self.metrics:
+			self.metrics.sent(command, len(msg), reply)
+
+	def _response(self):
+		# commit acks from earlier set_bounds can arrive ahead of any reply
+		while True:
+			res = self.conn.read(1)
+			if res != pack('B', uart.commit_ack):
+				if self.metrics and res:  # b'' is a timeout, not a reply
+					self.metrics.replied()
+				return res
+			self.commits_pending -= 1
+			if self.metrics:
+				self.metrics.committed()
+
+	def _ack(self):
+		return self._response() == pack('B', uart.ack)
+
 	@property
 	def alive(self):
-		self.conn.write(pack('B', uart.commands["ping"]))
-		res = self.conn.read(1)
-		return res == pack('B', uart.ping_res)
+		self._write("ping", pack('B', uart.commands["ping"]))
+		return self._response() == pack('B', uart.ping_res)
 	
 	def send_segment(self, index, coords: Tuple[int, int, int, int]):  # x y x y
-		if any([c > self.coord_max and c >= 0 for c in coords]):
-			raise ValueError(f"Coordinates must be in the range of 0 to {self.coord_max}")
+		coords = self._check_segments(coords)[0]
 
 		index %= self.index_max  # sure, why not wrap around?
 
+		if self.metrics:
+			started = monotonic()
 		msg = pack('<BH4B', uart.commands["write"], index, *coords)
-		self.conn.write(msg)
-		res = self.conn.read(1)
-		return res == pack('B', uart.ack)
-	
-	def set_bounds(self, start_index, end_index):
+		self._write("write", msg)
+		ok = self._ack()
+		self._mirror(index, coords, ok)
+		if self.metrics:
+			self.metrics.uploaded("write", 1, monotonic() - started)
+		return ok
+
+	def send_segments(self, start_index, segments, batch=None):
+		return self._send_runs([(start_index, self._check_segments(segments))], batch)
+
+	def _send_bulk(self, command, runs, batch=None, encode=np.ndarray.tobytes):
+		# Upload (start index, entries) runs with bulk writes, each batch acked
+		# once, its entries turned into bytes by encode. Batches are written
+		# ahead of their acks as long as all unacked bytes fit in rx_budget, so
+		# the link doesn't sit idle for a round trip and nothing is dropped if
+		# the device stalls meanwhile. By default a batch is small enough for
+		# two to be in flight.
+		if self.metrics:
+			started = monotonic()
+		ok = True
+		in_flight = deque()  # sizes of the batches not acked yet
+		for start_index, entries in runs:
+			entry_bytes = entries[:1].nbytes
+			if entry_bytes == 0:
+				continue
+			largest = (self.rx_budget - 5) // entry_bytes
+			size = min(batch or (self.rx_budget // 2 - 5) // entry_bytes, largest)
+			for offset in range(0, len(entries), size):
+				chunk = entries[offset:offset+size]
+				index = (start_index + offset) % self.index_max
+				msg = pack('<B2H', uart.commands[command], index, len(chunk))
+				msg += encode(chunk)
+				while in_flight and sum(in_flight) + len(msg) > self.rx_budget:
+					ok &= self._ack()
+					in_flight.popleft()
+				self._write(command, msg)
+				in_flight.append(len(msg))
+
+		for _ in in_flight:
+			ok &= self._ack()
+		if self.metrics:
+			self.metrics.uploaded(command, sum(len(entries) for _, entries in runs), monotonic() - started)
+		return ok
+
+	def _send_runs(self, runs, batch=None):
+		ok = self._send_bulk("write_bulk", runs, batch)
+		for start_index, segments in runs:
+			indices = (start_index + np.arange(len(segments))) % self.index_max
+			self._mirror(indices, segments, ok)
+		return ok
+
+	def upload_scene(self, segments, start_index=1, max_gap=1):
+		# Send only the segments that differ from what the device already holds.
+		# Changed indices are grouped into runs; a gap of up to `max_gap` unchanged
+		# segments is resent rather than paying for another 5 byte header.
+		segments = self._check_segments(segments)
+		indices = (start_index + np.arange(len(segments))) % self.index_max
+		changed = ~self.shadow_valid[indices] | (self.shadow[indices] != segments).any(axis=1)
+		positions = np.flatnonzero(changed)
+		if len(positions) == 0:
+			return True
+
+		breaks = np.flatnonzero(np.diff(positions) > max_gap + 1)
+		firsts = positions[np.r_[0, breaks + 1]]
+		lasts = positions[np.r_[breaks, len(positions) - 1]]
+		runs = [(start_index + first, segments[first:last+1]) for first, last in zip(firsts, lasts)]
+		return self._send_runs(runs)
+
+	def send_vertices(self, start_index, points, batch=None):
+		# Vertices for indexed ranges, 2 bytes each. They share segment memory:
+		# vertex i is stored like a segment from and to the same point.
+		points = np.asarray(points).reshape(-1, 2)
+		segments = self._check_segments(np.hstack([points, points]))
+		ok = self._send_bulk("write_vertices", [(start_index, segments[:, :2])], batch)
+		indices = (start_index + np.arange(len(segments))) % self.index_max
+		self._mirror(indices, segments, ok)
+		return ok
+
+	def send_edges(self, start_index, edges, batch=None):
+		# (start vertex, end vertex) index pairs into edge memory, 3.5 bytes each
+		edges = np.asarray(edges).reshape(-1, 2)
+		if ((edges < 0) | (edges >= self.index_max)).any():
+			raise ValueError(f"Vertex indices must be in the range of 0 to {self.index_max - 1}")
+		return self._send_bulk("write_edges", [(start_index, edges.astype('<u2'))], batch, pack_edges)
+
+	def send_mesh(self, vertex_index, edge_index, mesh):
+		# Upload a geometry.ArrayMesh for drawing as the indexed range
+		# (edge_index, edge_index + len(mesh.edges) - 1). Moving a vertex later
+		# only takes send_vertices of that one point.
+		points, edges = mesh.arrays()
+		ok = self.send_vertices(vertex_index, np.rint(points))
+		ok &= self.send_edges(edge_index, (edges + vertex_index) % self.index_max)
+		return ok
+
+	def send_offsets(self, start_index, offsets, batch=None):
+		# (dx, dy) pixel offsets for instanced ranges. They share edge memory with
+		# send_edges, as 14 bit two's complement pairs.
+		offsets = np.asarray(offsets).reshape(-1, 2)
+		if ((offsets < -2**13) | (offsets >= 2**13)).any():
+			raise ValueError(f"Offsets must be in the range of {-2**13} to {2**13 - 1}")
+		words = (offsets.astype(np.int64) & 0x3fff).astype('<u2')
+		return self._send_bulk("write_offsets", [(start_index, words)], batch, pack_edges)
+
+	def set_instances(self, range_index, offset_index, count, wait=True):
+		# Draw display list range `range_index` once per offset, using `count`
+		# offsets from `offset_index` on, added after the range's transform.
+		# A count of 0 draws it once without an offset. Committed at vsync like
+		# set_transform.
+		if not 0 <= range_index < uart.max_ranges:
+			raise ValueError(f"Range index must be in the range of 0 to {uart.max_ranges - 1}")
+		if not 0 <= count < self.index_max:
+			raise ValueError(f"Instance count must be in the range of 0 to {self.index_max - 1}")
+
+		msg = pack('<BB2H', uart.commands["set_instances"], range_index, offset_index % self.index_max, count)
+		return self._send_list("set_instances", msg, wait)
+
+	def set_bounds(self, start_index, end_index, wait=True):
+		# The device latches the bounds at the next vsync and sends commit_ack
+		# then. Without waiting, other commands can be sent in the meantime and
+		# the commit is confirmed by a later read or by wait_commit().
 		start_index %= self.index_max
 		end_index %= self.index_max
 
 		msg = pack('<B2H', uart.commands["set_bounds"], start_index, end_index)
-		self.conn.write(msg)
-		res = self.conn.read(1)
-		return res == pack('B', uart.ack)
+		return self._send_list("set_bounds", msg, wait)
+
+	def set_ranges(self, ranges, wait=True):
+		# Display list of (start, end) index ranges, all drawn every frame.
+		# A range given as (start, end, True) counts through edge memory and
+		# draws the edges between vertices from send_vertices instead.
+		# Committed at vsync the same way as set_bounds.
+		ranges = list(ranges)
+		if len(ranges) > uart.max_ranges:
+			raise ValueError(f"At most {uart.max_ranges} ranges fit in the display list")
+
+		msg = pack('<BB', uart.commands["set_ranges"], len(ranges))
+		for start, end, *indexed in ranges:
+			start %= self.index_max
+			if indexed and indexed[0]:
+				start |= uart.indexed_range
+			msg += pack('<2H', start, end % self.index_max)
+		return self._send_list("set_ranges", msg, wait)
+
+	def set_transform(self, range_index, matrix=((1, 0), (0, 1)), offset=(0, 0), wait=True):
+		# Affine transform the device applies to every segment of a display list
+		# range as it draws: x' = a*x + b*y + tx, y' = c*x + d*y + ty for
+		# matrix ((a, b), (c, d)) and offset (tx, ty). Segments ending up entirely
+		# off screen are dropped, the rest clamped. Committed at vsync like
+		# set_bounds, but sending one doesn't wait for an earlier commit.
+		if not 0 <= range_index < uart.max_ranges:
+			raise ValueError(f"Range index must be in the range of 0 to {uart.max_ranges - 1}")
+
+		matrix = np.asarray(matrix, dtype=float).reshape(4) * (1 << Affine.fraction_bits)
+		values = np.rint(np.r_[matrix, np.asarray(offset, dtype=float)])
+		if ((values < -2**15) | (values >= 2**15)).any():
+			raise ValueError("Transform doesn't fit in 16 bit fixed point")
+
+		msg = pack('<BB6h', uart.commands["set_transform"], range_index, *values.astype(int))
+		return self._send_list("set_transform", msg, wait)
+
+	def _send_list(self, command, msg, wait):
+		self._write(command, msg, reply=False)
+		self.commits_pending += 1
+		if wait:
+			return self.wait_commit()
+		return True
+
+	def wait_commit(self):
+		# how long this blocks is recorded as GPUMetrics.commit_wait
+		if self.commits_pending <= 0:
+			return True
+		if self.metrics:
+			started = monotonic()
+		ok = True
+		while self.commits_pending > 0:
+			if self.conn.read(1) != pack('B', uart.commit_ack):
+				ok = False
+				break
+			self.commits_pending -= 1
+			if self.metrics:
+				self.metrics.committed()
+		if self.metrics:
+			self.metrics.waited(monotonic() - started)
+		return ok
 	
 	def v_sync(self):
-		self.conn.write(pack('B', uart.commands["vsync"]))
-		res = self.conn.read(1)
-		return res == pack('B', uart.ack)
+		self._write("vsync", pack('B', uart.commands["vsync"]))
+		return self._ack()
+
+	def set_swap_mode(self, hold):
+		# With hold, a scene that takes longer than a frame to draw keeps the
+		# previous frame on screen instead of tearing. Stats.held_frames counts
+		# the vsyncs that didn't swap.
+		mode = uart.swap_modes["hold" if hold else "vsync"]
+		self._write("set_swap_mode", pack('BB', uart.commands["set_swap_mode"], mode))
+		return self._ack()
 	
-	def blank(self):
-		return self.set_bounds(0, 0)
+	def set_baud(self, rate):
+		# The device switches after acking and goes back to the old rate unless a
+		# ping arrives at the new one within about 1/3 s.
+		divisor = uart.divisor(rate, max_ppm=self.baud_max_ppm)
+		self._write("set_baud", pack('<BH', uart.commands["set_baud"], divisor))
+		if not self._ack():
+			return False
+
+		old_rate = self.conn.baudrate
+		timeout = self.conn.timeout
+		self.conn.baudrate = rate
+		self.conn.timeout = 0.1
+		try:
+			ok = self.alive
+		finally:
+			self.conn.timeout = timeout
 
+		if not ok:
+			self.conn.baudrate = old_rate
+			sleep(0.5)
+			self.conn.reset_input_buffer()
+			if not self.alive:
+				raise ConnectionError("Lost the device while changing baud rate")
+		return ok
 
-def transform(segment):
-	(xs, ys, xe, ye) = segment
-	xs += 160//2
-	ys += 120//2
-	xe += 160//2
-	ye += 120//2
-	return (xs, ys, xe, ye)
+	def negotiate_baud(self, rates=None):
+		# step up through the rates until one fails, and stay at the last good one
+		for rate in rates or self.baud_rates:
+			try:
+				if not self.set_baud(rate):
+					break
+			except uart.ArgumentError:
+				continue  # too far off at this clock, try the next one
+		return self.conn.baudrate
+
+	def stats(self):
+		self._write("stats", pack('B', uart.commands["stats"]))
+		if not self._ack():
+			raise ConnectionError("Stats request was not acknowledged")
+		data = self.conn.read(calcsize(uart.stats_format))
+		return Stats(*unpack(uart.stats_format, data))
+
+	def blank(self):
+		return self.set_bounds(0, 0)
 
 
 def main(flash=True):
@@ -98,16 +383,13 @@ def main(flash=True):
 
 
 	gpu.blank()
-	for i, seg in enumerate(square.serialize()):
-		gpu.send_segment(i+1, transform(seg))
-
-	for i, seg in enumerate(square2.serialize()):
-		gpu.send_segment(i+1+len(edges), transform(seg))
+	scheduler = FrameScheduler(gpu)
+	frames = [geometry.clip(mesh.translate(160//2, 120//2).segments()) for mesh in (square, square2)]
+	for i in range(600):
+		scheduler.submit(frames[i % 2])
+	scheduler.close()
+	print(scheduler.report())
 
-	for _ in range(300):
-		gpu.set_bounds(1, len(edges))
-		gpu.set_bounds(len(edges)+1, len(edges)*2)
-	
 	gpu.blank()
 	gpu.close()
 	print("done!")
@@ -0,0 +1,99 @@
+import json
+from time import monotonic
+from collections import deque, defaultdict
+
+
+class Histogram():
+	# durations in power of two buckets of microseconds, bucket i is under 2**i us
+	buckets = 32
+
+	def __init__(self):
+		self.counts = [0] * self.buckets
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+	def add(self, seconds):
+		self.counts[min(int(seconds * 1e6).bit_length(), self.buckets - 1)] += 1
+		self.count += 1
+		self.total += seconds
+		self.max = max(self.max, seconds)
+
+	def snapshot(self):
+		return {
+			"count": self.count,
+			"mean_us": self.total / self.count * 1e6 if self.count else 0,
+			"max_us": self.max * 1e6,
+			"buckets_us": {f"<{2**i}": n for i, n in enumerate(self.counts) if n},
+		}
+
+
+class CommandStats():
+	def __init__(self):
+		self.count = 0
+		self.bytes = 0
+		self.entries = 0  # segments, vertices, edges or offsets uploaded
+		self.upload_time = 0.0  # spent in the calls that uploaded them
+		self.latency = Histogram()  # from writing the command to its reply
+		self.commit = Histogram()  # from writing a display list command to its commit_ack
+
+	def snapshot(self):
+		return {
+			"count": self.count,
+			"bytes": self.bytes,
+			"entries": self.entries,
+			"entries_per_second": self.entries / self.upload_time if self.upload_time else 0,
+			"latency": self.latency.snapshot(),
+			"commit": self.commit.snapshot(),
+		}
+
+
+class GPUMetrics():
+	# Optional instrumentation for GPUConnection, per command name from
+	# uart.commands. Replies and commit acks arrive in the order their commands
+	# were sent, so each one is matched to the oldest command waiting for it.
+	def __init__(self):
+		self.commands = defaultdict(CommandStats)
+		self.replies = deque()  # (command, time sent) waiting for a reply
+		self.commits = deque()  # (command, time sent) waiting for a commit_ack
+		self.commit_wait = Histogram()  # time blocked in wait_commit, at vsync
+
+	def sent(self, command, size, reply=True):
+		stats = self.commands[command]
+		stats.count += 1
+		stats.bytes += size
+		(self.replies if reply else self.commits).append((command, monotonic()))
+
+	def replied(self):
+		if self.replies:
+			command, sent = self.replies.popleft()
+			self.commands[command].latency.add(monotonic() - sent)
+
+	def committed(self):
+		if self.commits:
+			command, sent = self.commits.popleft()
+			self.commands[command].commit.add(monotonic() - sent)
+
+	def uploaded(self, command, entries, seconds):
+		stats = self.commands[command]
+		stats.entries += entries
+		stats.upload_time += seconds
+
+	def waited(self, seconds):
+		# Long waits mean the device is still on the previous frame (render
+		# bound). Short ones with slow uploads mean the link is the limit.
+		self.commit_wait.add(seconds)
+
+	def drop_pending(self):
+		# after a reconnect nothing will answer them
+		self.replies.clear()
+		self.commits.clear()
+
+	def snapshot(self):
+		return {
+			"commands": {command: stats.snapshot() for command, stats in self.commands.items()},
+			"commit_wait": self.commit_wait.snapshot(),
+		}
+
+	def json(self, **kwargs):
+		return json.dumps(self.snapshot(), **kwargs)
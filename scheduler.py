@@ -0,0 +1,99 @@
+from time import monotonic
+
+import cost
+import geometry
+from allocator import SegmentAllocator
+
+
+class FrameScheduler():
+	# Double buffers segment memory: frame N+1 is uploaded into one region while
+	# the device draws frame N from the other, then a single set_bounds flips to
+	# it at the next vsync. Each upload only sends what changed since the frame
+	# before last, which used the same region.
+	frame_period = cost.frame_cycles / cost.px_freq
+
+	def __init__(self, gpu, region_size=None, allocator=None, budget=None):
+		self.gpu = gpu
+		self.budget = budget or cost.frame_budget()  # LineSet cycles a frame may take
+		self.allocator = allocator or SegmentAllocator(gpu.index_max)
+		if region_size is None:
+			region_size = self.allocator.largest_free() // 2
+		self.region_size = region_size
+		self.regions = [self.allocator.alloc(("frame", i), region_size) for i in range(2)]
+		self.back = 0  # region the next frame goes into
+		self.pending = False  # the last flip wasn't confirmed yet
+		self.shown = None  # estimated time of the vsync the last frame was shown at
+
+		self.frames = 0  # frames shown
+		self.late = 0  # frames that missed the vsync they were due at
+		self.dropped = 0  # frames skipped by submit to catch up
+		self.culled = 0  # segments left out to fit the budget
+
+	def _confirm(self):
+		# Wait for the last flip. A wait that blocked ended at a vsync, which keeps
+		# the estimate in step with the device's clock.
+		if not self.pending:
+			return True
+		waited = monotonic()
+		ok = self.gpu.wait_commit()
+		now = monotonic()
+		if now - waited > 1e-3:
+			self.shown = now
+		self.pending = False
+		return ok
+
+	def submit(self, segments, drop_late=False, priority=None):
+		# Upload an (N,4) array of x y x y and show it at the next vsync. With
+		# drop_late, a frame submitted after the vsync it was due at is skipped
+		# so an animation keeps its pace. Given a priority per segment, the
+		# lowest ones are left out of frames too heavy to draw in one refresh.
+		# Returns whether the frame was sent.
+		segments = geometry.check_segments(segments, self.gpu.coord_max)
+		if priority is not None:
+			keep = cost.cull(segments, priority, self.budget)
+			self.culled += int((~keep).sum())
+			segments = segments[keep]
+		if len(segments) > self.region_size:
+			raise ValueError(f"Frames must fit in {self.region_size} segments")
+		if not self._confirm():
+			raise ConnectionError("Frame flip was not acknowledged")
+
+		due = None if self.shown is None else self.shown + self.frame_period
+		if drop_late and due is not None and monotonic() > due:
+			self.shown = due  # that vsync showed the previous frame again
+			self.dropped += 1
+			return False
+
+		start = self.regions[self.back]
+		if not self.gpu.upload_scene(segments, start_index=start):
+			raise ConnectionError("Frame upload was not acknowledged")
+		if len(segments):
+			self.gpu.set_bounds(start, start + len(segments) - 1, wait=False)
+		else:
+			self.gpu.set_bounds(0, 0, wait=False)
+		self.pending = True
+		self.back ^= 1
+		self.frames += 1
+
+		# committed at the first vsync from now on
+		now = monotonic()
+		if due is None:
+			self.shown = now
+		elif now > due:
+			self.late += 1
+			self.shown = due + -(-(now - due) // self.frame_period) * self.frame_period
+		else:
+			self.shown = due
+		return True
+
+	def flush(self):
+		# wait until the last submitted frame is on screen
+		return self._confirm()
+
+	def report(self):
+		return {"frames": self.frames, "late": self.late, "dropped": self.dropped, "culled": self.culled}
+
+	def close(self):
+		self.flush()
+		for i in range(2):
+			self.allocator.release(("frame", i))
@@ -23,3 +23,23 @@ class Color:
 	@property
 	def rgb(self):
 		return Cat(self.b, self.g, self.r)
+
+
+class Affine:
+	# x' = (a*x + b*y >> 8) + tx, y' = (c*x + d*y >> 8) + ty
+	# a to d are signed 8.8 fixed point, tx and ty whole pixels. Resets to identity.
+	fraction_bits = 8
+
+	def __init__(self, name="affine"):
+		one = 1 << self.fraction_bits
+		self.a = Signal(signed(16), name=f"{name}_a", reset=one)
+		self.b = Signal(signed(16), name=f"{name}_b")
+		self.c = Signal(signed(16), name=f"{name}_c")
+		self.d = Signal(signed(16), name=f"{name}_d", reset=one)
+		self.tx = Signal(signed(16), name=f"{name}_tx")
+		self.ty = Signal(signed(16), name=f"{name}_ty")
+		self.width = 6*16
+
+	@property
+	def coefficients(self):
+		return Cat(self.a, self.b, self.c, self.d, self.tx, self.ty)
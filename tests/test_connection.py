@@ -0,0 +1,82 @@
+import numpy as np
+from struct import pack
+
+import uart
+from allocator import SegmentAllocator
+from geometry import Mesh, Point
+from main import GPUConnection
+
+
+class FakeSerial():
+	# acks every read and logs writes and reads in order
+	def __init__(self):
+		self.log = []
+
+	def write(self, msg):
+		self.log.append(("write", len(msg)))
+
+	def read(self, n):
+		self.log.append(("read", n))
+		return pack('B', uart.ack) * n
+
+
+def fake_connection():
+	gpu = GPUConnection.__new__(GPUConnection)
+	gpu.metrics = None
+	gpu.shadow = np.zeros((gpu.index_max, 4), dtype=np.uint8)
+	gpu.shadow_valid = np.zeros(gpu.index_max, dtype=bool)
+	gpu.commits_pending = 0
+	gpu.conn = FakeSerial()
+	return gpu
+
+
+def test_bulk_upload_keeps_two_batches_in_flight():
+	gpu = fake_connection()
+	assert gpu.send_segments(1, np.zeros((400, 4)))
+	log = gpu.conn.log
+	assert log[:2] == [("write", log[0][1]), ("write", log[0][1])]
+	# never more unacked bytes than the device's RX FIFO holds
+	in_flight = []
+	for op, size in log:
+		if op == "write":
+			in_flight.append(size)
+			assert sum(in_flight) <= gpu.rx_budget
+		else:
+			in_flight.pop(0)
+	assert not in_flight
+	assert gpu.shadow_valid[1:401].all()
+
+
+def test_send_segment_takes_serialized_meshes():
+	gpu = fake_connection()
+	mesh = Mesh([Point(20, 20), Point(20, 100), (40.6, 0)], [(0, 1), (1, 2)])
+	segments = mesh.serialize()
+	# the ints it was given, like before ArrayMesh
+	assert Mesh([Point(20, 20), Point(20, -20)], [(0, 1)]).serialize() == [(20, 20, 20, -20)]
+	assert all(type(c) is int for c in Mesh(mesh.points[:2], [(0, 1)]).serialize()[0])
+	assert all(gpu.send_segment(i, seg) for i, seg in enumerate(segments, 1))
+	assert gpu.shadow[1:3].tolist() == [[20, 20, 20, 100], [20, 100, 41, 0]]
+
+
+def test_send_segments_rounds():
+	gpu = fake_connection()
+	assert gpu.send_segments(1, [(0.4, 0.6, 254.5, 9.49)])
+	assert gpu.shadow[1].tolist() == [0, 1, 254, 9]
+
+
+def test_compact_never_overlaps_the_old_copy():
+	gpu = fake_connection()
+	allocator = SegmentAllocator()
+	for handle, length in [("a", 4), ("b", 8), ("c", 2), ("d", 2)]:
+		start = allocator.alloc(handle, length)
+		assert gpu.send_segments(start, np.full((length, 4), ord(handle)))
+	allocator.release("a")
+	allocator.release("c")
+
+	# b doesn't fit in a's hole, d does fit in c's
+	assert allocator.compact(gpu, max_moves=2) == ["d"]
+	assert allocator.ranges["b"] == (5, 8)
+	assert allocator.ranges["d"] == (13, 2)
+	assert (gpu.shadow[5:13] == ord("b")).all()
+	assert (gpu.shadow[13:15] == ord("d")).all()
+	assert allocator.free == [(1, 4), (15, allocator.size - 15)]
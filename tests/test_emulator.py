@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+from emulator import GPUEmulator, line_color
+from geometry import ArrayMesh
+from main import GPUConnection
+from metrics import GPUMetrics
+from scheduler import FrameScheduler
+
+
+@pytest.fixture
+def emulated():
+	gpu = GPUEmulator(frame_rate=240)
+	gpu.start()
+	conn = GPUConnection(gpu.port)
+	conn.conn.timeout = 2  # a lost reply fails the test instead of hanging it
+	yield gpu, conn
+	conn.close()
+	gpu.stop()
+
+
+def test_ping(emulated):
+	_, conn = emulated
+	assert conn.alive
+
+
+def test_segments_are_drawn_after_commit(emulated):
+	gpu, conn = emulated
+	segments = np.array([(10, 10, 50, 10), (10, 20, 10, 60), (0, 0, 100, 100)])
+	# small batches so several bulk writes are in flight
+	assert conn.send_segments(1, segments, batch=2)
+	assert (gpu.segments[1:4] == segments).all()
+	assert conn.set_bounds(1, 3)
+	assert conn.commits_pending == 0
+
+	# the commit lands at one vsync, the frame is drawn by the next
+	assert conn.v_sync()
+	assert conn.v_sync()
+	stats = conn.stats()
+	assert stats.segments == 3
+	assert stats.pixels > 0
+	assert (gpu.displayed[10, 10:51] == line_color).all()
+
+
+def test_commit_acks_ahead_of_replies(emulated):
+	_, conn = emulated
+	assert conn.set_bounds(1, 1, wait=False)
+	assert conn.set_bounds(1, 2, wait=False)
+	assert conn.v_sync()  # reads past the commit acks that arrived first
+	assert conn.wait_commit()
+	assert conn.commits_pending == 0
+
+
+def test_mesh_edges_round_trip(emulated):
+	gpu, conn = emulated
+	rng = np.random.default_rng(0)
+	points = rng.integers(0, 120, (40, 2))
+	edges = rng.integers(0, 40, (101, 2))  # odd, so the last entry is padded
+	assert conn.send_mesh(100, 200, ArrayMesh(points, edges))
+	assert (gpu.edges[200:301] == edges + 100).all()
+	assert (gpu.segments[100:140, :2] == points).all()
+
+
+def test_metrics_only_count_real_replies_and_waits(emulated):
+	_, conn = emulated
+	conn.metrics = GPUMetrics()
+	assert conn.wait_commit()  # nothing pending, no sample
+	assert conn.metrics.commit_wait.count == 0
+
+	conn.conn.timeout = 0.01
+	conn._write("ping", b'')  # waits for a reply that never comes
+	assert conn._response() == b''
+	assert conn.metrics.commands["ping"].latency.count == 0
+
+	conn.conn.timeout = 2
+	assert conn.set_bounds(1, 1)
+	assert conn.metrics.commit_wait.count == 1
+
+
+def test_scheduler_flips_between_regions(emulated):
+	gpu, conn = emulated
+	scheduler = FrameScheduler(conn)
+	assert scheduler.region_size == (conn.index_max - 1) // 2
+	frames = [np.array([(0, 0, 10, i)]) for i in range(3)]
+	for frame in frames:
+		assert scheduler.submit(frame)
+	assert scheduler.flush()
+	first, second = scheduler.regions
+	assert (gpu.segments[first] == frames[2]).all()
+	assert (gpu.segments[second] == frames[1]).all()
+	assert gpu.ranges == [(first, first, False)]
+	scheduler.close()
@@ -0,0 +1,58 @@
+import numpy as np
+
+from geometry import ArrayMesh, Mesh, Point, clip
+
+
+def polyline(points):
+	points = np.asarray(points, dtype=float)
+	return ArrayMesh(points, np.c_[np.arange(len(points) - 1), np.arange(1, len(points))])
+
+
+def test_simplify_merges_points_in_a_cell():
+	# a dense line along x, 10 points per pixel
+	mesh = polyline(np.c_[np.linspace(0, 9.95, 200), np.full(200, 0.5)])
+	simple = mesh.simplify(1)
+	assert len(simple.points) == 10
+	assert len(simple.edges) == 9
+	assert np.all(simple.edges < len(simple.points))
+	assert np.allclose(simple.points[:, 1], 0.5)
+
+
+def test_simplify_drops_collapsed_and_duplicate_edges():
+	mesh = ArrayMesh([(0.1, 0.1), (0.2, 0.2), (5, 5)], [(0, 1), (1, 2), (0, 2), (2, 0)])
+	simple = mesh.simplify(1)
+	assert len(simple.points) == 2
+	assert len(simple.edges) == 1
+
+
+def test_simplify_keeps_mesh_type():
+	square = Mesh([Point(0, 0), Point(4, 0), Point(4, 4)], [(0, 1), (1, 2)])
+	simple = square.simplify(0.5)
+	assert isinstance(simple, Mesh)
+	assert isinstance(simple.points[0], Point)
+	assert simple.serialize() == square.serialize()
+
+
+def test_lod_cache_hits_and_evicts():
+	mesh = polyline(np.c_[np.linspace(0, 100, 500), np.linspace(0, 50, 500)])
+	mesh.lod_cache_size = 2
+	first = mesh.lod(1)
+	assert mesh.lod(1) is first
+	assert mesh.lod(2, scale=2) is first  # same tolerance in the mesh's units
+	mesh.lod(2)
+	mesh.lod(4)
+	assert len(mesh._lods) == 2
+	assert mesh.lod(1) is not first  # least recently used, evicted
+
+
+def test_lod_for_budget_picks_coarser_levels_for_smaller_budgets():
+	mesh = polyline(np.c_[np.linspace(0, 150, 3000), 60 + 50*np.sin(np.linspace(0, 30, 3000))])
+	full = mesh.lod_for_budget(budget=10**6)
+	tight = mesh.lod_for_budget(budget=2000)
+	assert full is mesh
+	assert len(tight.edges) < len(mesh.edges)
+
+
+def test_clip_drops_segments_that_round_to_a_point():
+	segments = [(10.2, 10.1, 10.4, 9.8), (5, 5, 5, 5), (-10, 20, 30.4, 20), (200, 0, 300, 0)]
+	assert clip(segments).tolist() == [[0, 20, 30, 20]]
@@ -1,21 +1,41 @@
 #!/usr/bin/env python3
 from amaranth import *
+from amaranth.lib.cdc import PulseSynchronizer
 from amaranth_boards.icebreaker import ICEBreakerPlatform
-from structures import Coords
+from structures import Coords, Affine
 
-from uart import UART, commands, ping_res, ack
+from uart import UART, commands, ping_res, ack, commit_ack, max_ranges, swap_modes
 from vga import VGA, vga_resource
 from framebuffer import FrameBuffer
 from lines import LineSet
 
 class Top(Elaboratable):
-	def __init__(self):
+	def __init__(self, drawers=1, fast_render=False):
 		self.what = Signal()
+		self.drawers = drawers
+		# LineSet and the framebuffer writes run in this domain, the render one
+		# is twice as fast as px
+		self.render_domain = "render" if fast_render else "px"
 
 	def elaborate(self, platform):
 		m = Module()
+		rd = self.render_domain
 
-		m.submodules.vga = vga = VGA(delay=2)
+		def to_render(pulse, name):
+			if rd == "px":
+				return pulse
+			m.submodules[name] = sync = PulseSynchronizer("px", rd)
+			m.d.comb += sync.i.eq(pulse)
+			return sync.o
+
+		def to_px(pulse, name):
+			if rd == "px":
+				return pulse
+			m.submodules[name] = sync = PulseSynchronizer(rd, "px")
+			m.d.comb += sync.i.eq(pulse)
+			return sync.o
+
+		m.submodules.vga = vga = VGA(delay=2, render=rd != "px")
 
 		btn = platform.request("button")
 		last = Signal()
@@ -28,7 +48,7 @@ class Top(Elaboratable):
 			with m.If(btn.i & ~last):
 				m.d.px += step.eq(1)
 
-		m.submodules.fb = fb = FrameBuffer()
+		m.submodules.fb = fb = FrameBuffer(write_domain=rd)
 		
 		# colors are:  black  red    green  yellow blue   purple cyan   white
 		colorscheme = [0x000, 0xb44, 0x9b6, 0xfc7, 0x7ab, 0xb7a, 0x7ba, 0xfff] # terminal
@@ -38,11 +58,30 @@ class Top(Elaboratable):
 			m.d.comb += fb.palette[i].eq(color)
 		m.d.px += vga.color.rgb.eq(fb.color.rgb)
 
+		# In hold mode the buffers only swap at a vsync once LineSet has finished
+		# the frame, so an overrun shows the previous frame again rather than a
+		# half drawn one. The displayed buffer isn't filled on read then, and the
+		# one swapped out is cleared before drawing instead.
+		hold_mode = Signal()  # set by set_swap_mode, taken at the next swap
+		holding = Signal()  # hold mode, for the frame being displayed
+		frame_complete = Signal()  # LineSet finished drawing since the last swap
+		clear_back = Signal()  # the buffer being drawn wasn't filled on read
+		swap = Signal()
+		held_frames = Signal(16)  # vsyncs without a swap
+		m.d.comb += swap.eq(vga.frame & (~holding | frame_complete))
+		with m.If(swap):
+			m.d.px += [holding.eq(hold_mode), clear_back.eq(holding)]
+		with m.If(vga.frame & ~swap):
+			m.d.px += held_frames.eq(held_frames + 1)
+
+		# each framebuffer word covers pixels_per_word pixels of 4x4 screen pixels
+		word_x_bits = 2 + (FrameBuffer.pixels_per_word - 1).bit_length()
 		m.d.comb += [
 			fb.coords_r.x.eq(vga.coords.x>>2),
 			fb.coords_r.y.eq(vga.coords.y>>2),
-			fb.read_fill.eq(vga.valid_data & (vga.coords.x[:2] == 3) & (vga.coords.y[:2] == 3)),
-			fb.swap.eq(vga.frame)
+			fb.read_fill.eq(vga.valid_data & ~holding
+				& (vga.coords.x[:word_x_bits] == 2**word_x_bits - 1) & (vga.coords.y[:2] == 3)),
+			fb.swap.eq(swap)
 		]
 
 		m.submodules.uart = uart = UART(platform.request("uart"))
@@ -51,38 +90,238 @@ class Top(Elaboratable):
 
 		empty = Signal(reset=1)
 		m.d.comb += [
-			uart.rx_ack.eq(1),  # received data is always acted upon immediately
+			# received data is acted upon immediately, except by states that are
+			# waiting on something else, which leave it in the FIFO
+			uart.rx_ack.eq(1),
 		]
 		m.d.px += [
 			uart.tx_data.eq(~uart.rx_data),
 			uart.tx_ready.eq(0)
 		]
 
-		m.submodules.line = line = LineSet(160,120)
+		line = LineSet(160,120, drawers=self.drawers, max_ranges=max_ranges,
+			span=FrameBuffer.pixels_per_word)
+		if rd != "px":
+			line = DomainRenamer({"px": rd})(line)
+		m.submodules.line = line
 		m.d.comb += [
 			fb.coords_w.xy.eq(line.coords.xy),
+			fb.w_mask.eq(line.mask),
 			fb.write.eq(line.write),
 			fb.fill_data.eq(4), # background color
 			fb.w_data.eq(1), # line color
 		]
 
+		# performance counters, reported by the stats command. Segments, pixels and
+		# busy cycles count up during a frame and are latched at vga.frame. They
+		# count in LineSet's domain, so busy cycles are render clock cycles.
+		segments_drawn = Signal(32)  # instanced ranges can draw more than 2**16
+		pixels_written = Signal(32)
+		busy_cycles = Signal(32)
+		segments_last = Signal.like(segments_drawn)
+		pixels_last = Signal.like(pixels_written)
+		busy_last = Signal.like(busy_cycles)
+		overruns = Signal(16)  # frames where LineSet was still drawing at vga.frame
+		rx_errors = Signal(16)
+		rx_error_last = Signal()
+
+		frame = to_render(vga.frame, "frame_sync")
+		with m.If(frame):
+			m.d[rd] += [
+				segments_last.eq(segments_drawn),
+				pixels_last.eq(pixels_written),
+				busy_last.eq(busy_cycles),
+				segments_drawn.eq(0),
+				pixels_written.eq(0),
+				busy_cycles.eq(0),
+			]
+			with m.If(line.busy):
+				m.d[rd] += overruns.eq(overruns + 1)
+		with m.Else():
+			m.d[rd] += [
+				segments_drawn.eq(segments_drawn + line.drawn),
+				pixels_written.eq(pixels_written + Mux(line.write, sum(line.mask), 0)),
+				busy_cycles.eq(busy_cycles + line.busy),
+			]
+
+		# what the stats command sends, copied into px once they're latched
+		report = [segments_last, pixels_last, busy_last, overruns]
+		if rd != "px":
+			latched = Signal()
+			m.d[rd] += latched.eq(frame)
+			report_ready = to_px(latched, "report_sync")
+			report = [Signal.like(counter, name=f"{counter.name}_px") for counter in report]
+			with m.If(report_ready):
+				m.d.px += [copy.eq(counter) for copy, counter in
+					zip(report, [segments_last, pixels_last, busy_last, overruns])]
+
+		m.d.px += rx_error_last.eq(uart.rx_error)
+		with m.If(uart.rx_error & ~rx_error_last):
+			m.d.px += rx_errors.eq(rx_errors + 1)
+
+		# a new baud rate stays only if a ping arrives at it before the timeout
+		divisor_new = Signal.like(uart.divisor)
+		divisor_old = Signal.like(uart.divisor)
+		baud_timeout = Signal(23)  # about 1/3 s
+
+		stats_data = Signal(8 + 32 + 32 + 32 + 16 + 16 + 16)
+		stats_count = Signal(range(len(stats_data)//8 + 1))
+
 		#m.d.px += line.length.eq(1)
 		index_write = Signal(16)
+		remaining = Signal(16)  # segments left in the current write command
+		# what a bulk write carries, and the state its entries start in
+		# (instance offsets share edge memory and are written just like edges)
+		bulk_kinds = {"write_bulk": "WR_X0", "write_vertices": "VTX_X", "write_edges": "EDGE_0",
+			"write_offsets": "EDGE_0"}
+		bulk_kind = Signal(range(len(bulk_kinds)))
+		edge = Signal(28)  # both vertex indices of the edge being received
 
 		endpoints = [Coords(160, 120), Coords(160, 120)]
 		index_start = Signal(14)
 		index_end = Signal(14)
-		m.d.px += line.request_write.eq(0)
+		index_indexed = Signal()  # top bit of the start index marks an indexed range
+
+		# The display list is written here by set_bounds and set_ranges without
+		# stalling the command FSM, and copied into LineSet at the next frame.
+		# Each list gets a commit_ack once that happens. A list arriving while
+		# another is pending replaces it, and both are acked at that commit. While
+		# one is still being received, the pending one is not copied and waits to
+		# be acked with it at the commit after.
+		# set_transform and set_instances work the same way, except that they
+		# never wait: the parameters of a range are written in one cycle, so a
+		# commit never sees half of them.
+		list_starts = Array(Signal(14, name=f"list_start{i}") for i in range(max_ranges))
+		list_ends = Array(Signal(14, name=f"list_end{i}") for i in range(max_ranges))
+		list_indexed = Array(Signal(name=f"list_indexed{i}") for i in range(max_ranges))
+		list_count = Signal.like(line.range_count)
+		list_index = Signal(8)
+		list_length = Signal(8)
+		list_pending = Signal()
+		list_receiving = Signal()
+		list_received = Signal()
+		transforms = [Affine(name=f"staged_transform{i}") for i in range(max_ranges)]
+		instance_bases = [Signal(14, name=f"staged_instance_base{i}") for i in range(max_ranges)]
+		instance_counts = [Signal(14, name=f"staged_instance_count{i}") for i in range(max_ranges)]
+		# command: payload bits after the range index, and how to store them for range i
+		range_params = {
+			"set_transform": (transforms[0].width,
+				lambda i, data: transforms[i].coefficients.eq(data)),
+			"set_instances": (32,
+				lambda i, data: [instance_bases[i].eq(data[:14]), instance_counts[i].eq(data[16:30])]),
+		}
+		# bytes are shifted in from the top, so the last command ends at the top
+		param_in = Signal(8 + max(width for width, _ in range_params.values()))
+		param_bytes = Signal(range(len(param_in)//8 + 1))
+		param_length = Signal.like(param_bytes)
+		param_kind = Signal(range(len(range_params)))
+		param_received = Signal()
+		commits_due = Signal(8)  # commands waiting for the next commit
+		lists_due = Signal(8)  # of those, display lists, held back with a list being received
+		lists_held = Signal.like(lists_due)
+		commit = Signal()
+		commit_list = Signal()
+		# The copy happens in LineSet's domain. Until it's confirmed back, the
+		# staging registers are left alone.
+		commit_busy = Signal()
+		committing = Signal.like(commits_due)  # commands in the commit being copied
+		committed = Signal()
+		commit_sent = Signal()
+		commit_acks = Signal(8)  # commits not acked yet
+
+		# at a swap, so a held frame is finished with the display list it started with
+		m.d.comb += commit.eq(swap & (commits_due != 0))
+		m.d.comb += commit_list.eq(commit & list_pending & ~list_receiving)
+		with m.If(to_render(commit, "commit_sync")):
+			m.d[rd] += committed.eq(1)
+			for i in range(max_ranges):
+				m.d[rd] += line.range_transforms[i].coefficients.eq(transforms[i].coefficients)
+				m.d[rd] += line.range_instance_bases[i].eq(instance_bases[i])
+				m.d[rd] += line.range_instance_counts[i].eq(instance_counts[i])
+		with m.Else():
+			m.d[rd] += committed.eq(0)
+		with m.If(to_render(commit_list, "commit_list_sync")):
+			m.d[rd] += line.range_count.eq(list_count)
+			for i in range(max_ranges):
+				m.d[rd] += line.range_starts[i].eq(list_starts[i])
+				m.d[rd] += line.range_ends[i].eq(list_ends[i])
+				m.d[rd] += line.range_indexed[i].eq(list_indexed[i])
+		commit_done = to_px(committed, "commit_done_sync")
+
+		with m.If(list_received):
+			m.d.px += [list_pending.eq(1), list_receiving.eq(0)]
+		with m.Elif(commit_list):
+			m.d.px += list_pending.eq(0)
+		with m.If(commit_list):
+			m.d.px += lists_due.eq(list_received)
+		with m.Else():
+			m.d.px += lists_due.eq(lists_due + list_received)
+		# a list that doesn't go in with this commit is acked with the one that does
+		m.d.comb += lists_held.eq(Mux(commit_list, 0, lists_due))
+		with m.If(commit):
+			m.d.px += commits_due.eq(lists_held + (list_received | param_received))
+			m.d.px += committing.eq(commits_due - lists_held)
+			m.d.px += commit_busy.eq(1)
+		with m.Else():
+			m.d.px += commits_due.eq(commits_due + (list_received | param_received))
+			with m.If(commit_done):
+				m.d.px += commit_busy.eq(0)
+		m.d.px += commit_acks.eq(commit_acks + Mux(commit_done, committing, 0) - commit_sent)
+
+		# one write into segment or edge memory
+		request_write = Signal()
+		m.d.px += request_write.eq(0)
+		m.d.comb += line.request_write.eq(to_render(request_write, "write_sync"))
 		with m.FSM(reset="CMD", domain="px"):
 			with m.State("CMD"):
-				with m.If(uart.rx_ready):
+				with m.If(commit_acks != 0):
+					# between commands so it never lands inside another reply, and only
+					# with room in the TX FIFO. tx_ready is registered, so a byte queued
+					# last cycle lands first, like in STATS_SEND.
+					m.d.comb += uart.rx_ack.eq(0)
+					with m.If(uart.tx_ack & ~uart.tx_ready):
+						m.d.comb += commit_sent.eq(1)
+						m.d.px += [uart.tx_data.eq(commit_ack), uart.tx_ready.eq(1)]
+				with m.Elif(uart.rx_ready & commit_busy &
+						((uart.rx_data == commands["set_bounds"]) |
+						(uart.rx_data == commands["set_ranges"]))):
+					m.d.comb += uart.rx_ack.eq(0)  # wait a few cycles for the copy
+				with m.Elif(uart.rx_ready):
 					with m.If(uart.rx_data == commands["ping"]):
 						# reply with 0x42
 						m.d.px += [uart.tx_data.eq(ping_res), uart.tx_ready.eq(1)]
 					with m.Elif(uart.rx_data == commands["write"]):
+						m.d.px += remaining.eq(1)
 						m.next = "WR_IDX0"
+					for i, command in enumerate(bulk_kinds):
+						with m.Elif(uart.rx_data == commands[command]):
+							m.d.px += bulk_kind.eq(i)
+							m.next = "BULK_IDX0"
+					with m.Elif(uart.rx_data == commands["set_baud"]):
+						m.next = "BAUD0"
+					with m.Elif(uart.rx_data == commands["set_swap_mode"]):
+						m.next = "SWAP_MODE"
+					with m.Elif(uart.rx_data == commands["stats"]):
+						m.d.px += [
+							stats_data.eq(Cat(C(ack, 8), *report, rx_errors, held_frames)),
+							stats_count.eq(0),
+						]
+						m.next = "STATS_SEND"
 					with m.Elif(uart.rx_data == commands["set_bounds"]):
+						# a display list with a single range
+						m.d.px += [list_index.eq(0), list_length.eq(1), list_receiving.eq(1)]
 						m.next = "BOUNDS_S0"
+					with m.Elif(uart.rx_data == commands["set_ranges"]):
+						m.d.px += [list_index.eq(0), list_receiving.eq(1)]
+						m.next = "RANGES_N"
+					for i, (command, (width, _)) in enumerate(range_params.items()):
+						with m.Elif(uart.rx_data == commands[command]):
+							m.d.px += [
+								param_kind.eq(i),
+								param_bytes.eq(0),
+								param_length.eq(1 + width//8),
+							]
+							m.next = "PARAMS"
 					with m.Elif(uart.rx_data == commands["vsync"]):
 						m.next = "VSYNC"
 
@@ -106,15 +345,99 @@ class Top(Elaboratable):
 				with m.If(uart.rx_ready):
 					m.d.px += endpoints[1].x.eq(uart.rx_data)
 					m.next = "WR_Y1"
+			def write_entry(first_state):
+				m.d.px += line.index_write.eq(index_write)
+				m.d.px += request_write.eq(1)
+				with m.If(remaining == 1):
+					m.d.px += [uart.tx_data.eq(ack), uart.tx_ready.eq(1)]
+					m.next = "CMD"
+				with m.Else():
+					# bulk write: next entry goes in the next slot, one ack at the end
+					m.d.px += remaining.eq(remaining - 1)
+					m.d.px += index_write.eq(index_write + 1)
+					m.next = first_state
+
 			with m.State("WR_Y1"):
 				with m.If(uart.rx_ready):
 					m.d.px += line.endpoints_in[0].xy.eq(endpoints[0].xy)
 					m.d.px += line.endpoints_in[1].x.eq(endpoints[1].x)
 					m.d.px += line.endpoints_in[1].y.eq(uart.rx_data)
-					m.d.px += line.index_write.eq(index_write)
-					m.d.px += line.request_write.eq(1)
-					m.d.px += [uart.tx_data.eq(ack), uart.tx_ready.eq(1)]
-					m.next = "CMD"
+					m.d.px += line.edge_write.eq(0)
+					write_entry("WR_X0")
+
+			# a vertex goes to both halves of segment memory, see _EdgeMemory
+			with m.State("VTX_X"):
+				with m.If(uart.rx_ready):
+					m.d.px += endpoints[0].x.eq(uart.rx_data)
+					m.next = "VTX_Y"
+			with m.State("VTX_Y"):
+				with m.If(uart.rx_ready):
+					for endpoint in line.endpoints_in:
+						m.d.px += endpoint.x.eq(endpoints[0].x)
+						m.d.px += endpoint.y.eq(uart.rx_data)
+					m.d.px += line.edge_write.eq(0)
+					write_entry("VTX_X")
+
+			# Edges are a little-endian stream of 28 bit entries, two 14 bit indices
+			# each, so every 7 bytes carry two. The nibble left over after the
+			# first one starts the second.
+			for i in range(3):
+				with m.State(f"EDGE_{i}"):
+					with m.If(uart.rx_ready):
+						m.d.px += edge[8*i:8*i+8].eq(uart.rx_data)
+						m.next = f"EDGE_{i+1}"
+			with m.State("EDGE_3"):
+				with m.If(uart.rx_ready):
+					m.d.px += line.vertices_in[0].eq(edge[:14])
+					m.d.px += line.vertices_in[1].eq(Cat(edge[14:24], uart.rx_data[:4]))
+					m.d.px += line.edge_write.eq(1)
+					m.d.px += edge[:4].eq(uart.rx_data[4:])
+					write_entry("EDGE_4")
+			for i in range(4, 6):
+				with m.State(f"EDGE_{i}"):
+					with m.If(uart.rx_ready):
+						m.d.px += edge[8*i-28:8*i-20].eq(uart.rx_data)
+						m.next = f"EDGE_{i+1}"
+			with m.State("EDGE_6"):
+				with m.If(uart.rx_ready):
+					m.d.px += line.vertices_in[0].eq(edge[:14])
+					m.d.px += line.vertices_in[1].eq(Cat(edge[14:20], uart.rx_data))
+					m.d.px += line.edge_write.eq(1)
+					write_entry("EDGE_0")
+
+			with m.State("BULK_IDX0"):
+				with m.If(uart.rx_ready):
+					m.d.px += index_write[:8].eq(uart.rx_data)
+					m.next = "BULK_IDX1"
+			with m.State("BULK_IDX1"):
+				with m.If(uart.rx_ready):
+					m.d.px += index_write[8:].eq(uart.rx_data)
+					m.next = "BULK_CNT0"
+			with m.State("BULK_CNT0"):
+				with m.If(uart.rx_ready):
+					m.d.px += remaining[:8].eq(uart.rx_data)
+					m.next = "BULK_CNT1"
+			with m.State("BULK_CNT1"):
+				with m.If(uart.rx_ready):
+					m.d.px += remaining[8:].eq(uart.rx_data)
+					with m.If(Cat(remaining[:8], uart.rx_data) == 0):
+						m.d.px += [uart.tx_data.eq(ack), uart.tx_ready.eq(1)]
+						m.next = "CMD"
+					with m.Else():
+						with m.Switch(bulk_kind):
+							for i, state in enumerate(bulk_kinds.values()):
+								with m.Case(i):
+									m.next = state
+
+			with m.State("RANGES_N"):
+				with m.If(uart.rx_ready):
+					m.d.px += list_length.eq(uart.rx_data)
+					with m.If(uart.rx_data == 0):
+						m.d.px += list_count.eq(0)
+						m.d.comb += list_received.eq(1)
+						m.next = "CMD"
+					with m.Else():
+						m.next = "BOUNDS_S0"
 
 			with m.State("BOUNDS_S0"):
 				with m.If(uart.rx_ready):
@@ -123,6 +446,7 @@ class Top(Elaboratable):
 			with m.State("BOUNDS_S1"):
 				with m.If(uart.rx_ready):
 					m.d.px += index_start[8:].eq(uart.rx_data)
+					m.d.px += index_indexed.eq(uart.rx_data[7])
 					m.next = "BOUNDS_E0"
 			with m.State("BOUNDS_E0"):
 				with m.If(uart.rx_ready):
@@ -130,36 +454,167 @@ class Top(Elaboratable):
 					m.next = "BOUNDS_E1"
 			with m.State("BOUNDS_E1"):
 				with m.If(uart.rx_ready):
-					m.d.px += index_end[8:].eq(uart.rx_data)
-					m.next = "BOUNDS_COMMIT"
-			with m.State("BOUNDS_COMMIT"):
-				with m.If(vga.frame):
-					m.d.px += line.index_start.eq(index_start)
-					m.d.px += line.index_end.eq(index_end)
+					with m.If(list_index < max_ranges):  # extra ranges are dropped
+						m.d.px += [
+							list_starts[list_index].eq(index_start),
+							list_ends[list_index].eq(Cat(index_end[:8], uart.rx_data)),
+							list_indexed[list_index].eq(index_indexed),
+						]
+					with m.If(list_index + 1 == list_length):
+						m.d.px += list_count.eq(Mux(list_length > max_ranges, max_ranges, list_length))
+						m.d.comb += list_received.eq(1)
+						m.next = "CMD"
+					with m.Else():
+						m.d.px += list_index.eq(list_index + 1)
+						m.next = "BOUNDS_S0"
+			
+			with m.State("PARAMS"):
+				with m.If(uart.rx_ready):
+					m.d.px += [
+						param_in.eq(Cat(param_in[8:], uart.rx_data)),
+						param_bytes.eq(param_bytes + 1),
+					]
+					with m.If(param_bytes + 1 == param_length):
+						m.next = "PARAMS_SET"
+			with m.State("PARAMS_SET"):
+				m.d.comb += uart.rx_ack.eq(0)
+				with m.If(~commit_busy):
+					with m.Switch(param_kind):
+						for kind, (width, store) in enumerate(range_params.values()):
+							with m.Case(kind):
+								received = param_in[len(param_in) - 8 - width:]
+								with m.Switch(received[:8]):  # unknown ranges are dropped
+									for i in range(max_ranges):
+										with m.Case(i):
+											m.d.px += store(i, received[8:])
+					m.d.comb += param_received.eq(1)
+					m.next = "CMD"
+
+			# ack followed by the counters, one byte whenever the TX FIFO has room
+			with m.State("STATS_SEND"):
+				m.d.comb += uart.rx_ack.eq(0)
+				with m.If(uart.tx_ack):
+					m.d.px += [
+						uart.tx_data.eq(stats_data[:8]),
+						uart.tx_ready.eq(1),
+						stats_data.eq(stats_data >> 8),
+						stats_count.eq(stats_count + 1),
+					]
+					m.next = "STATS_WAIT"
+			with m.State("STATS_WAIT"):
+				m.d.comb += uart.rx_ack.eq(0)
+				# tx_ready is registered, let it land before checking tx_ack again
+				with m.If(stats_count == len(stats_data)//8):
+					m.next = "CMD"
+				with m.Else():
+					m.next = "STATS_SEND"
+
+			with m.State("BAUD0"):
+				with m.If(uart.rx_ready):
+					m.d.px += divisor_new[:8].eq(uart.rx_data)
+					m.next = "BAUD1"
+			with m.State("BAUD1"):
+				with m.If(uart.rx_ready):
+					m.d.px += divisor_new[8:].eq(uart.rx_data)
 					m.d.px += [uart.tx_data.eq(ack), uart.tx_ready.eq(1)]
+					m.next = "BAUD_ACK"
+			with m.State("BAUD_ACK"):
+				m.d.comb += uart.rx_ack.eq(0)
+				# the ack reaches the TX FIFO this cycle
+				m.next = "BAUD_FLUSH"
+			with m.State("BAUD_FLUSH"):
+				m.d.comb += uart.rx_ack.eq(0)
+				# switch only once the ack is out at the old rate
+				with m.If(uart.tx_idle):
+					m.d.comb += [
+						uart.divisor_in.eq(divisor_new),
+						uart.divisor_write.eq(1),
+					]
+					m.d.px += [
+						divisor_old.eq(uart.divisor),
+						baud_timeout.eq(-1),
+					]
+					m.next = "BAUD_CHECK"
+			with m.State("BAUD_CHECK"):
+				m.d.px += baud_timeout.eq(baud_timeout - 1)
+				with m.If(uart.rx_ready & (uart.rx_data == commands["ping"])):
+					m.d.px += [uart.tx_data.eq(ping_res), uart.tx_ready.eq(1)]
 					m.next = "CMD"
-			
+				with m.Elif(uart.rx_ready | (baud_timeout == 0)):
+					m.d.comb += [
+						uart.divisor_in.eq(divisor_old),
+						uart.divisor_write.eq(1),
+					]
+					m.next = "CMD"
+
+			with m.State("SWAP_MODE"):
+				with m.If(uart.rx_ready):
+					m.d.px += hold_mode.eq(uart.rx_data == swap_modes["hold"])
+					m.d.px += [uart.tx_data.eq(ack), uart.tx_ready.eq(1)]
+					m.next = "CMD"
+
 			with m.State("VSYNC"):
+				m.d.comb += uart.rx_ack.eq(0)
 				with m.If(vga.frame):
 					m.d.px += [uart.tx_data.eq(ack), uart.tx_ready.eq(1)]
 					m.next = "CMD"
 				
 		# do this one step after updating the counters
-		m.d.px += line.start.eq(vga.frame)
+		start = Signal()
+		m.d.px += start.eq(swap)
+
+		# In LineSet's domain, a start waits for the back buffer to be cleared if
+		# needed. In hold mode it also waits for the previous frame to finish, where
+		# LineSet would have dropped it. holding and clear_back are px registers,
+		# but they only change at a swap, well before the start gets across.
+		render_start = to_render(start, "start_sync")
+		start_pending = Signal()
+		clear_pending = Signal()
+		start_ready = Signal()
+		m.d.comb += [
+			start_ready.eq(start_pending & ~line.busy & ~fb.clearing),
+			fb.clear.eq(start_ready & clear_pending),
+			line.start.eq(start_ready & ~clear_pending),
+		]
+		with m.If(render_start & (holding | ~line.busy)):
+			m.d[rd] += [start_pending.eq(1), clear_pending.eq(clear_back)]
+		with m.Elif(fb.clear):
+			m.d[rd] += clear_pending.eq(0)
+		with m.Elif(line.start):
+			m.d[rd] += start_pending.eq(0)
+
+		# reported once LineSet is idle again after the start, busy rises a cycle late
+		drawing = Signal()
+		started = Signal()
+		finished = Signal()
+		m.d[rd] += started.eq(line.start)
+		with m.If(render_start):
+			m.d[rd] += drawing.eq(0)
+		with m.Elif(line.start):
+			m.d[rd] += drawing.eq(1)
+		with m.Elif(drawing & ~started & ~line.busy):
+			m.d[rd] += drawing.eq(0)
+			m.d.comb += finished.eq(1)
+		px_finished = to_px(finished, "finished_sync")
+		with m.If(start):
+			m.d.px += frame_complete.eq(0)
+		with m.Elif(px_finished):
+			m.d.px += frame_complete.eq(1)
 
 		return m
 
 
-def build_and_run():
+def build_and_run(fast_render=False):
 	board = ICEBreakerPlatform()
 	board.add_resources([vga_resource])
 	board.add_resources(board.break_off_pmod)
 	from subprocess import CalledProcessError
 	try:
-		board.build(Top(), do_program=True)
+		board.build(Top(fast_render=fast_render), do_program=True)
 	except CalledProcessError:
 		print("Can't find iCE FTDI USB device")
 
 from amaranth.build import *
 if __name__ == "__main__":
-	build_and_run()
\ No newline at end of file
+	import sys
+	build_and_run(fast_render="--fast-render" in sys.argv)
\ No newline at end of file
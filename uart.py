@@ -1,45 +1,87 @@
 #!/usr/bin/env python3
 # https://github.com/icebreaker-fpga/icebreaker-amaranth-examples/blob/master/icebreaker/uart/uart.py
 from ctypes import ArgumentError
+from collections import namedtuple
 from amaranth import *
 from amaranth.build import *
+from amaranth.lib.fifo import SyncFIFOBuffered
 
 baud = 115200
+clk_freq = 25125000  # px domain
 ping_res = 0x42
 ack = 0xbd
+commit_ack = 0xc3  # sent from between commands once a display list command takes effect
 
 commands = {
 	"ping": 0,
 	"write": 1,
 	"set_bounds": 2,
-	"vsync": 3
+	"vsync": 3,
+	"write_bulk": 4,
+	"stats": 5,
+	"set_baud": 6,
+	"set_ranges": 7,
+	"set_transform": 8,
+	"write_vertices": 9,
+	"write_edges": 10,
+	"write_offsets": 11,
+	"set_instances": 12,
+	"set_swap_mode": 13
 }
 
+indexed_range = 0x8000  # flag on the start index of a display list range
+
+max_ranges = 8  # entries in the display list set by "set_ranges"
+
+# Bytes the RX FIFO holds while the command FSM is busy. There is no flow
+# control back to the host, and a byte arriving at a full FIFO is dropped and
+# misaligns the command stream, so hosts keep at most this many bytes unacked.
+rx_depth = 512
+
+# "set_swap_mode" payload: swap at every vsync, or only once the frame is drawn,
+# showing the previous one again until then
+swap_modes = {"vsync": 0, "hold": 1}
+
+# reply to "stats" after its ack, little endian
+stats_fields = ["segments", "pixels", "busy_cycles", "overruns", "rx_errors", "held_frames"]
+stats_format = '<3I3H'
+Stats = namedtuple("Stats", stats_fields)
+
 def _divisor(freq_in, freq_out, max_ppm=None):
-	divisor = freq_in // freq_out
-	if divisor <= 0:
+	divisor = round(freq_in / freq_out)
+	if divisor <= 1:
 		raise ArgumentError("Output frequency is too high.")
 
-	ppm = 100000 * ((freq_in / divisor) - freq_out) / freq_out
+	ppm = 1000000 * abs((freq_in / divisor) - freq_out) / freq_out
 	if max_ppm is not None and ppm > max_ppm:
 		raise ArgumentError("Output frequency deviation is too high.")
 
 	return divisor
 
+def divisor(baud_rate, max_ppm=None):
+	# what set_baud carries for a baud rate, ArgumentError if the px clock can't make it
+	return _divisor(clk_freq, baud_rate, max_ppm)
+
 
 class UART(Elaboratable):
-	def __init__(self, serial, clk_freq=25125000, baud_rate=baud):
+	def __init__(self, serial, clk_freq=clk_freq, baud_rate=baud, rx_depth=rx_depth, tx_depth=16):
+		self.rx_depth = rx_depth
+		self.tx_depth = tx_depth
+
+		# rx_data is valid while rx_ready, rx_ack takes it out of the FIFO
 		self.rx_data = Signal(8)
 		self.rx_ready = Signal()
 		self.rx_ack = Signal()
-		self.rx_error = Signal()
+		self.rx_error = Signal()  # framing error or a byte dropped on a full FIFO
 		self.rx_strobe = Signal()
 		self.rx_bitno = None
 		self.rx_fsm = None
 
+		# tx_ready queues tx_data, which only sticks while tx_ack (room in the FIFO)
 		self.tx_data = Signal(8)
 		self.tx_ready = Signal()
 		self.tx_ack = Signal()
+		self.tx_idle = Signal()  # nothing queued or being sent
 		self.tx_strobe = Signal()
 		self.tx_bitno = None
 		self.tx_latch = None
@@ -47,15 +89,35 @@ class UART(Elaboratable):
 
 		self.serial = serial
 
-		self.divisor = _divisor(
-			freq_in=clk_freq, freq_out=baud_rate, max_ppm=50000)
+		# clock cycles per bit, can be changed at runtime through divisor_in
+		self.divisor = Signal(16, reset=_divisor(
+			freq_in=clk_freq, freq_out=baud_rate, max_ppm=50000))
+		self.divisor_in = Signal(16)
+		self.divisor_write = Signal()
 
 	def elaborate(self, _platform: Platform) -> Module:
 		m = Module()
 
+		with m.If(self.divisor_write):
+			m.d.px += self.divisor.eq(self.divisor_in)
+
+		# deep enough RX FIFO ends up in block RAM
+		m.submodules.rx_fifo = rx_fifo = DomainRenamer("px")(
+			SyncFIFOBuffered(width=8, depth=self.rx_depth))
+		m.submodules.tx_fifo = tx_fifo = DomainRenamer("px")(
+			SyncFIFOBuffered(width=8, depth=self.tx_depth))
+		m.d.comb += [
+			self.rx_data.eq(rx_fifo.r_data),
+			self.rx_ready.eq(rx_fifo.r_rdy),
+			rx_fifo.r_en.eq(self.rx_ack),
+			tx_fifo.w_data.eq(self.tx_data),
+			tx_fifo.w_en.eq(self.tx_ready),
+			self.tx_ack.eq(tx_fifo.w_rdy),
+		]
+
 		# RX
 
-		rx_counter = Signal(range(self.divisor))
+		rx_counter = Signal.like(self.divisor)
 		m.d.comb += self.rx_strobe.eq(rx_counter == 0)
 		with m.If(rx_counter == 0):
 			m.d.px += rx_counter.eq(self.divisor - 1)
@@ -63,10 +125,12 @@ class UART(Elaboratable):
 			m.d.px += rx_counter.eq(rx_counter - 1)
 
 		self.rx_bitno = rx_bitno = Signal(3)
+		rx_shift = Signal(8)
+		rx_idle_bits = Signal(4)
 		with m.FSM(reset="IDLE", domain="px") as self.rx_fsm:
 			with m.State("IDLE"):
 				with m.If(~self.serial.rx):
-					m.d.px += rx_counter.eq(self.divisor // 2)
+					m.d.px += rx_counter.eq(self.divisor >> 1)
 					m.next = "START"
 
 			with m.State("START"):
@@ -76,8 +140,7 @@ class UART(Elaboratable):
 			with m.State("DATA"):
 				with m.If(self.rx_strobe):
 					m.d.px += [
-						self.rx_data.eq(
-							Cat(self.rx_data[1:8], self.serial.rx)),
+						rx_shift.eq(Cat(rx_shift[1:8], self.serial.rx)),
 						rx_bitno.eq(rx_bitno + 1)
 					]
 					with m.If(rx_bitno == 7):
@@ -86,23 +149,30 @@ class UART(Elaboratable):
 			with m.State("STOP"):
 				with m.If(self.rx_strobe):
 					with m.If(~self.serial.rx):
+						m.d.px += rx_idle_bits.eq(0)
 						m.next = "ERROR"
 					with m.Else():
-						m.next = "FULL"
-
-			with m.State("FULL"):
-				m.d.comb += self.rx_ready.eq(1)
-				with m.If(self.rx_ack):
-					m.next = "IDLE"
-				with m.Elif(~self.serial.rx):
-					m.next = "ERROR"
+						m.d.comb += [
+							rx_fifo.w_data.eq(rx_shift),
+							rx_fifo.w_en.eq(1),
+							self.rx_error.eq(~rx_fifo.w_rdy),
+						]
+						m.next = "IDLE"
 
 			with m.State("ERROR"):
+				# resynchronize once the line has idled for a whole frame
 				m.d.comb += self.rx_error.eq(1)
+				with m.If(self.rx_strobe):
+					with m.If(~self.serial.rx):
+						m.d.px += rx_idle_bits.eq(0)
+					with m.Elif(rx_idle_bits == 9):
+						m.next = "IDLE"
+					with m.Else():
+						m.d.px += rx_idle_bits.eq(rx_idle_bits + 1)
 
 		# TX
 
-		tx_counter = Signal(range(self.divisor))
+		tx_counter = Signal.like(self.divisor)
 		m.d.comb += self.tx_strobe.eq(tx_counter == 0)
 		with m.If(tx_counter == 0):
 			m.d.px += tx_counter.eq(self.divisor - 1)
@@ -113,11 +183,12 @@ class UART(Elaboratable):
 		self.tx_latch = tx_latch = Signal(8)
 		with m.FSM(reset="IDLE", domain="px") as self.tx_fsm:
 			with m.State("IDLE"):
-				m.d.comb += self.tx_ack.eq(1)
-				with m.If(self.tx_ready):
+				m.d.comb += self.tx_idle.eq(~self.tx_ready & (tx_fifo.level == 0))
+				with m.If(tx_fifo.r_rdy):
+					m.d.comb += tx_fifo.r_en.eq(1)
 					m.d.px += [
 						tx_counter.eq(self.divisor - 1),
-						tx_latch.eq(self.tx_data)
+						tx_latch.eq(tx_fifo.r_data)
 					]
 					m.next = "START"
 				with m.Else():
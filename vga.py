@@ -19,15 +19,55 @@ vga_resource = Resource(
 # 40MHz clock for 800x600 60Hz display.
 # also still outputs 12MHz for running main logic
 # 25MHz for 640x480 display
+# With render set, there is a render domain at 50.25MHz instead of the 12MHz
+# output. It comes from the same VCO as px, so it is exactly twice as fast and
+# in phase with it.
 class VGA_PLL(Elaboratable):
-	def __init__(self):
+	def __init__(self, render=False):
+		self.render = render
 		#self.clk39_750 = Signal(attrs = {"keep": "true"})
 		self.clk25_125 = Signal(attrs = {"keep": "true"})
 		self.clk12 = Signal(attrs = {"keep": "true"})
+		self.clk50_25 = Signal(attrs = {"keep": "true"})
 	
 	def elaborate(self, platform):
 		m = Module()
 		platform.lookup(platform.default_clk).attrs['GLOBAL'] = False
+		if self.render:
+			m.submodules.pll = Instance(
+				'SB_PLL40_2F_PAD',
+				i_PACKAGEPIN = platform.request('clk12').i,
+				i_RESETB = Const(1),
+				i_BYPASS = Const(0),
+
+				o_PLLOUTGLOBALA = self.clk50_25,
+				o_PLLOUTGLOBALB = self.clk25_125,
+
+				p_FEEDBACK_PATH = 'SIMPLE',
+				p_PLLOUT_SELECT_PORTA = 'GENCLK',
+				p_PLLOUT_SELECT_PORTB = 'GENCLK_HALF',
+
+				p_DIVR = 0,
+				p_DIVF = 66,
+				p_DIVQ = 4,
+				p_FILTER_RANGE = 1
+			)
+
+			# nothing runs at 12MHz, so sync just follows px here
+			platform.add_clock_constraint(self.clk50_25, 50.25e6)
+			platform.add_clock_constraint(self.clk25_125, 25.125e6)
+			m.domains += [
+				ClockDomain('sync'),
+				ClockDomain('px'),
+				ClockDomain('render')
+			]
+			m.d.comb += [
+				ClockSignal('sync').eq(self.clk25_125),
+				ClockSignal('px').eq(self.clk25_125),
+				ClockSignal('render').eq(self.clk50_25)
+			]
+			return m
+
 		m.submodules.pll = Instance(
 			'SB_PLL40_2_PAD',
 			i_PACKAGEPIN = platform.request('clk12').i,
@@ -136,14 +176,17 @@ class VGA_Timing(Elaboratable):
 
 # instantiates the PLL and sets up chip IO for you
 class VGA(Elaboratable):
-	def __init__(self, delay=0):
-		# 800x600, 60Hz -> 40MHz px clock
-		# sync width, back porch, active region, front porch
+	# 800x600, 60Hz -> 40MHz px clock
+	# sync width, back porch, active region, front porch
+	#h_timing = {"sync": 128, "bp": 88, "active": 800, "fp": 40}
+	#v_timing = {"sync":   4, "bp": 23, "active": 600, "fp":  1}
+	h_timing = {"sync": 96, "bp": 48, "active": 640, "fp": 16}
+	v_timing = {"sync":  2, "bp": 33, "active": 480, "fp": 10}
+	frame_cycles = sum(h_timing.values()) * sum(v_timing.values())  # px cycles per frame
+
+	def __init__(self, delay=0, render=False):
 		self.delay = delay
-		#self.h_timing = {"sync": 128, "bp": 88, "active": 800, "fp": 40}
-		#self.v_timing = {"sync":   4, "bp": 23, "active": 600, "fp":  1}
-		self.h_timing = {"sync": 96, "bp": 48, "active": 640, "fp": 16}
-		self.v_timing = {"sync":  2, "bp": 33, "active": 480, "fp": 10}
+		self.render = render  # see VGA_PLL
 
 		# inputs
 		self.color = Color(4)
@@ -158,7 +201,7 @@ class VGA(Elaboratable):
 	def elaborate(self, platform):
 		m = Module()
 
-		m.submodules.clock = VGA_PLL()
+		m.submodules.clock = VGA_PLL(self.render)
 		m.submodules.timing_h = VGA_Timing_h = VGA_Timing(self.h_timing, self.delay)
 		m.submodules.timing_v = VGA_Timing_v = VGA_Timing(self.v_timing, 0)
 